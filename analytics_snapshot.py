@@ -0,0 +1,241 @@
+import os
+from datetime import datetime, timedelta
+
+import click
+import numpy as np
+from sqlalchemy import select
+
+from models import db, Customer, Transaction, Event
+from process_data import (SEGMENTATION_FIELDS, MULTI_VALUE_SEGMENTS, metrics_row, write_metrics,
+                          segment_metrics_row, write_segmented_metrics)
+
+# Event types the metrics look at; other events are not loaded
+SNAPSHOT_EVENT_TYPES = ['visit', 'BROWSE', 'MAIL_OPEN', 'MAIL_CLICK']
+
+# Rows fetched and converted to arrays at a time while loading a snapshot
+SNAPSHOT_CHUNK_SIZE = int(os.environ.get("SNAPSHOT_CHUNK_SIZE", 10000))
+
+
+def _epoch_seconds(values):
+    """Convert datetimes (or None) to int64 epoch seconds; missing values become the int64 minimum."""
+    return np.array(values, dtype='datetime64[s]').astype(np.int64)
+
+
+def _encode(values, labels):
+    """Dictionary-encode segment values into int32 codes, adding new values to `labels` (label -> code).
+
+    Empty values are labelled 'Unknown', as in SegmentedMetrics.segment.
+    """
+    return np.fromiter((labels.setdefault(str(value) if value else 'Unknown', len(labels)) for value in values),
+                       dtype=np.int32, count=len(values))
+
+
+def _load_columns(statement, convert):
+    """Run `statement` SNAPSHOT_CHUNK_SIZE rows at a time, turning each chunk's columns into arrays.
+
+    `convert(columns)` gets one tuple of values per selected column and returns
+    a tuple of arrays; the per-chunk arrays are concatenated position by position.
+    Only one chunk of Python row objects is alive at a time, so peak memory is
+    set by the arrays rather than by the rows.
+    """
+    chunks = []
+    result = db.session.connection().execute(statement.execution_options(yield_per=SNAPSHOT_CHUNK_SIZE))
+    for partition in result.partitions():
+        chunks.append(convert(list(zip(*partition))))
+    if not chunks:
+        chunks.append(convert([()] * len(statement.selected_columns)))
+    return [np.concatenate(arrays) for arrays in zip(*chunks)]
+
+
+class IntegrationSnapshot:
+    """Columnar, in-memory copy of one integration's customers, transactions and events.
+
+    Customers are numbered 0..n-1; transactions and events reference them by
+    that index (-1 when the customer is unknown). Dates are int64 epoch seconds,
+    revenue is float64 and segment columns are dictionary encoded. Segments are
+    stored as (customer index, segment code) membership pairs, so single-valued
+    columns and multi-valued ones (tags, mailing lists) are handled the same way.
+
+    A loaded snapshot can be asked for metrics with any lookback, without going
+    back to the database.
+    """
+
+    def __init__(self, integration_id):
+        self.integration_id = integration_id
+        self.segments = {}  # field -> (member customer indexes, member codes, labels)
+
+    @classmethod
+    def load(cls, integration_id):
+        snapshot = cls(integration_id)
+        snapshot._load_customers()
+        snapshot._load_transactions()
+        snapshot._load_events()
+        return snapshot
+
+    def _load_customers(self):
+        single_fields = [field for field in SEGMENTATION_FIELDS if field not in MULTI_VALUE_SEGMENTS]
+        self.customer_index = {}
+        field_labels = {field: {} for field in single_fields}
+
+        def convert(columns):
+            ids, cb_ids, signups, *values = columns
+            self.customer_index.update((cb_id, len(self.customer_index)) for cb_id in cb_ids)
+            return (np.array(ids, dtype=np.int64), _epoch_seconds(signups),
+                    *[_encode(field_values, field_labels[field]) for field, field_values in zip(single_fields, values)])
+
+        customer_ids, self.signup, *field_codes = _load_columns(
+            select(Customer.id, Customer.cb_id, Customer.signup_date,
+                   *[getattr(Customer, field) for field in single_fields])
+            .where(Customer.custobar_integration_id == self.integration_id)
+            .order_by(Customer.id),
+            convert)
+        self.customer_count = len(customer_ids)
+
+        every_customer = np.arange(self.customer_count)
+        for field, codes in zip(single_fields, field_codes):
+            self.segments[field] = (every_customer, codes, list(field_labels[field]))
+
+        for field, (model, column) in MULTI_VALUE_SEGMENTS.items():
+            labels = {}
+            link_customers, codes = _load_columns(
+                select(model.customer_id, getattr(model, column))
+                .where(model.custobar_integration_id == self.integration_id),
+                lambda columns: (np.searchsorted(customer_ids, np.array(columns[0], dtype=np.int64)),
+                                 _encode(columns[1], labels)))
+
+            # Customers without any value belong to the 'Unknown' segment
+            without_values = np.setdiff1d(every_customer, link_customers)
+            codes = np.concatenate([codes, _encode([None] * len(without_values), labels)])
+            self.segments[field] = (np.concatenate([link_customers, without_values]), codes, list(labels))
+
+    def _customer_indexes(self, cb_ids):
+        return np.fromiter((self.customer_index.get(cb_id, -1) for cb_id in cb_ids), dtype=np.int64,
+                           count=len(cb_ids))
+
+    def _load_transactions(self):
+        self.transaction_customer, self.transaction_date, self.revenue = _load_columns(
+            select(Transaction.cb_id, Transaction.transaction_date, Transaction.revenue)
+            .where(Transaction.custobar_integration_id == self.integration_id),
+            lambda columns: (self._customer_indexes(columns[0]), _epoch_seconds(columns[1]),
+                             np.array(columns[2], dtype=np.float64)))
+
+    def _load_events(self):
+        type_codes = {event_type: code for code, event_type in enumerate(SNAPSHOT_EVENT_TYPES)}
+        self.event_customer, self.event_type, self.event_date = _load_columns(
+            select(Event.cb_id, Event.event_type, Event.date)
+            .where(Event.custobar_integration_id == self.integration_id,
+                   Event.event_type.in_(SNAPSHOT_EVENT_TYPES)),
+            lambda columns: (self._customer_indexes(columns[0]),
+                             np.fromiter((type_codes[event_type] for event_type in columns[1]), dtype=np.int8,
+                                         count=len(columns[1])),
+                             _epoch_seconds(columns[2])))
+
+    def _per_customer(self, cutoff):
+        """Per-customer aggregates for a lookback cutoff, as arrays indexed by customer."""
+        n = self.customer_count
+        known = self.transaction_customer >= 0
+        in_window = self.transaction_date >= cutoff
+        window = known & in_window
+        recent_events = (self.event_customer >= 0) & (self.event_date >= cutoff)
+
+        def events_of(event_type):
+            mask = recent_events & (self.event_type == SNAPSHOT_EVENT_TYPES.index(event_type))
+            return np.bincount(self.event_customer[mask], minlength=n)
+
+        window_transactions = np.bincount(self.transaction_customer[window], minlength=n)
+        return {
+            "total_customers": np.ones(n),
+            "new_customers": (self.signup >= cutoff).astype(np.float64),
+            "active_customers": (window_transactions > 0).astype(np.float64),
+            "total_revenue": np.bincount(self.transaction_customer[window], weights=self.revenue[window],
+                                         minlength=n),
+            "num_transactions": window_transactions,
+            "total_revenue_for_clv": np.bincount(self.transaction_customer[known], weights=self.revenue[known],
+                                                 minlength=n),
+            "total_customers_for_clv": (np.bincount(self.transaction_customer[known], minlength=n) > 0)
+            .astype(np.float64),
+            "visitors": events_of('BROWSE'),
+            "mail_open_count": events_of('MAIL_OPEN'),
+            "mail_click_count": events_of('MAIL_CLICK'),
+        }
+
+    def metrics(self, lookback=3000, today=None):
+        """Return the raw totals calculate_metrics would compute, for any lookback."""
+        cutoff = _cutoff(lookback, today)
+        in_window = self.transaction_date >= cutoff
+        recent_events = self.event_date >= cutoff
+
+        def count_events(event_type, mask=True):
+            return int(np.count_nonzero(mask & (self.event_type == SNAPSHOT_EVENT_TYPES.index(event_type))))
+
+        return {
+            "total_customers": self.customer_count,
+            "new_customers": int(np.count_nonzero(self.signup >= cutoff)),
+            "active_customers": len(np.unique(self.transaction_customer[in_window & (self.transaction_customer >= 0)])),
+            "total_revenue": float(self.revenue.sum()),
+            "window_revenue": float(self.revenue[in_window].sum()),
+            "all_transactions": len(self.revenue),
+            "num_transactions": int(np.count_nonzero(in_window)),
+            "visitors": count_events('visit'),
+            "mail_open_count": count_events('MAIL_OPEN', recent_events),
+            "mail_click_count": count_events('MAIL_CLICK', recent_events),
+        }
+
+    def segmented_metrics(self, fields=None, lookback=3000, today=None):
+        """Return {field: {label: raw segment aggregates}} via grouped bincounts."""
+        per_customer = self._per_customer(_cutoff(lookback, today))
+        result = {}
+        for field in fields or SEGMENTATION_FIELDS:
+            members, codes, labels = self.segments[field]
+            sums = {key: np.bincount(codes, weights=values[members], minlength=len(labels))
+                    for key, values in per_customer.items()}
+            result[field] = {
+                label: {key: _plain_number(key, sums[key][code]) for key in sums}
+                for code, label in enumerate(labels)
+            }
+        return result
+
+
+def _cutoff(lookback, today=None):
+    today = today or datetime.utcnow().date()
+    return np.datetime64(today - timedelta(days=lookback), 's').astype(np.int64)
+
+
+def _plain_number(key, value):
+    """Turn a bincount result back into an int count or a float revenue."""
+    return float(value) if key.startswith("total_revenue") else int(round(value))
+
+
+def populate_metrics_from_snapshot(integration_id, lookback=3000, snapshot=None):
+    """Compute and store today's Metrics and SegmentedMetrics from a columnar snapshot."""
+    today = datetime.utcnow().date()
+    snapshot = snapshot or IntegrationSnapshot.load(integration_id)
+
+    write_metrics(integration_id, today, metrics_row(snapshot.metrics(lookback, today)))
+
+    for field, segments in snapshot.segmented_metrics(lookback=lookback, today=today).items():
+        rows = [segment_metrics_row(field, label, segment) for label, segment in segments.items()]
+        write_segmented_metrics(integration_id, today, rows)
+
+    db.session.commit()
+    return snapshot
+
+
+@click.command('snapshot-metrics')
+@click.option('--integration', 'integration_id', type=int, required=True, help='Integration id to compute.')
+@click.option('--lookback', 'lookbacks', type=int, multiple=True,
+              help='Lookback in days; repeat to compare several. Defaults to 3000.')
+@click.option('--write/--no-write', default=False, help='Store the first lookback as today\'s metrics.')
+def snapshot_metrics_command(integration_id, lookbacks, write):
+    """Compute metrics from an in-memory columnar snapshot, e.g. for what-if lookbacks."""
+    lookbacks = lookbacks or (3000,)
+    snapshot = IntegrationSnapshot.load(integration_id)
+    print(f"Loaded {snapshot.customer_count} customers, {len(snapshot.revenue)} transactions, "
+          f"{len(snapshot.event_type)} events")
+
+    for lookback in lookbacks:
+        print(f"lookback {lookback} days: {metrics_row(snapshot.metrics(lookback))}")
+
+    if write:
+        populate_metrics_from_snapshot(integration_id, lookbacks[0], snapshot)
+        print("Metrics populated successfully")
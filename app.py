@@ -4,7 +4,10 @@ from flask_bcrypt import Bcrypt
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
 from models import db  # Import db instance from models.py
+from database import DATABASE_URL, init_database
 from flask_migrate import Migrate
+import instrumentation
+from structured_logging import configure_logging
 
 # Initialize extensions
 bcrypt = Bcrypt()
@@ -12,16 +15,21 @@ jwt = JWTManager()
 migrate = Migrate()
 
 # Application factory function
-def create_app():
+def create_app(config=None):
+    configure_logging()  # Leveled logging through a background queue; see LOG_LEVEL / LOG_FORMAT
     app = Flask(__name__)
 
-    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///users.db"
+    app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URL  # From DATABASE_URL, sqlite:///users.db by default
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config["JWT_SECRET_KEY"] = "supersecretkey"  # Change this in production
 
-    # Initialize extensions with the app
-    db.init_app(app)
+    # Overrides, e.g. a scratch database for benchmarks
+    app.config.update(config or {})
+
+    # Initialize extensions with the app; SQLite gets WAL and tuned pragmas, server databases a sized pool
+    init_database(app)
     migrate = Migrate(app, db)
+    instrumentation.init_app(app)  # Query counts and stage timings, served at /metrics
 
     bcrypt.init_app(app)
     jwt.init_app(app)
@@ -37,14 +45,33 @@ def create_app():
     from routes.user_routes import user_bp
     from routes.integration_routes import integration_bp
     from routes.calculation_routes import calculation_bp
+    from routes.job_routes import job_bp
+    from routes.metrics_routes import metrics_bp
 
     app.register_blueprint(user_bp, url_prefix='/user')
     app.register_blueprint(integration_bp, url_prefix='/integration')
     app.register_blueprint(calculation_bp, url_prefix='/calculation')
+    app.register_blueprint(job_bp, url_prefix='/job')
+    app.register_blueprint(metrics_bp)
+
+    # CLI commands, e.g. `flask compute-metrics --workers 8`
+    from batch_metrics import compute_metrics_command
+    from query_plans import explain_metrics_command
+    from analytics_snapshot import snapshot_metrics_command
+    from jobs import fail_interrupted_jobs_command
+    app.cli.add_command(compute_metrics_command)
+    app.cli.add_command(explain_metrics_command)
+    app.cli.add_command(snapshot_metrics_command)
+    app.cli.add_command(fail_interrupted_jobs_command)
 
     return app
 
 
 if __name__ == "__main__":
     app = create_app()
+    # Jobs run in the server process, so any still queued or running were cut off by a restart.
+    # Servers with several worker processes run `flask fail-interrupted-jobs` before starting instead.
+    from jobs import fail_interrupted_jobs
+    with app.app_context():
+        fail_interrupted_jobs()
     app.run(debug=True)
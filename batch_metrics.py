@@ -0,0 +1,90 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import click
+
+from models import db, CustobarIntegration
+from process_data import (calculate_metrics, calculate_segmented_metrics, update_last_action_and_purchase_dates,
+                          SEGMENTATION_FIELDS)
+
+# App used by each worker process, created once per process by _init_worker
+_worker_app = None
+
+
+def _init_worker():
+    """Create a separate app, and so a separate engine and DB connection, per worker process."""
+    global _worker_app
+    from app import create_app
+    _worker_app = create_app()
+
+
+def _run_task(integration_id, task):
+    """Run one unit of metric work: 'metrics', 'last_dates' or a segmentation field name."""
+    started = time.perf_counter()
+    with _worker_app.app_context():
+        if task == 'metrics':
+            calculate_metrics(integration_id)
+        elif task == 'last_dates':
+            update_last_action_and_purchase_dates(integration_id)
+        else:
+            calculate_segmented_metrics(integration_id, fields=[task])
+    return integration_id, task, time.perf_counter() - started
+
+
+def build_tasks(integration_ids, fields=None):
+    """List the (integration_id, task) pairs that make up a full metrics run."""
+    tasks = []
+    for integration_id in integration_ids:
+        tasks.append((integration_id, 'metrics'))
+        tasks.extend((integration_id, field) for field in fields or SEGMENTATION_FIELDS)
+        tasks.append((integration_id, 'last_dates'))
+    return tasks
+
+
+def compute_metrics_batch(integration_ids, workers=None, fields=None):
+    """Compute Metrics and SegmentedMetrics for many integrations across CPU cores.
+
+    Every integration's overall metrics, each of its segmentation fields and its
+    last-date update is a separate task on a process pool. Returns a list of
+    (integration_id, task, error) for the tasks that failed.
+    """
+    tasks = build_tasks(integration_ids, fields)
+    failures = []
+
+    # Worker processes open their own connections; don't hand them ours
+    db.engine.dispose()
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker) as executor:
+        futures = {executor.submit(_run_task, integration_id, task): (integration_id, task)
+                   for integration_id, task in tasks}
+        for future in as_completed(futures):
+            integration_id, task = futures[future]
+            try:
+                _, _, elapsed = future.result()
+                print(f"Integration {integration_id}: {task} done in {elapsed:.1f}s")
+            except Exception as e:
+                print(f"Integration {integration_id}: {task} failed: {e}")
+                failures.append((integration_id, task, str(e)))
+
+    return failures
+
+
+@click.command('compute-metrics')
+@click.option('--integration', 'integration_ids', type=int, multiple=True,
+              help='Integration id to compute; repeat for several. Defaults to all integrations.')
+@click.option('--field', 'fields', multiple=True, type=click.Choice(SEGMENTATION_FIELDS),
+              help='Segmentation field to compute; repeat for several. Defaults to all fields.')
+@click.option('--workers', type=int, default=None, help='Worker processes. Defaults to the CPU count.')
+def compute_metrics_command(integration_ids, fields, workers):
+    """Compute metrics for many integrations in parallel."""
+    if not integration_ids:
+        integration_ids = [integration_id for (integration_id,) in db.session.query(CustobarIntegration.id).all()]
+
+    started = time.perf_counter()
+    failures = compute_metrics_batch(list(integration_ids), workers=workers, fields=list(fields) or None)
+    print(f"Computed metrics for {len(integration_ids)} integrations in {time.perf_counter() - started:.1f}s "
+          f"({len(failures)} failed tasks)")
+
+    if failures:
+        raise SystemExit(1)
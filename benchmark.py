@@ -0,0 +1,312 @@
+"""Benchmark the ingestion and metric pipeline against a synthetic tenant.
+
+Generates Custobar-shaped customers, sales and events into a scratch SQLite
+database, runs each pipeline stage and records its wall time, rows/s, query
+count and peak memory (RSS sampled during the stage, and optionally traced
+Python allocations). Results are written as JSON; pass a previous results
+file with --baseline to print the change per stage.
+
+    python benchmark.py --customers 100000 --transactions 1000000 --events 2000000
+"""
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from itertools import accumulate
+
+import click
+from sqlalchemy import event
+
+from models import db, User, CustobarIntegration
+from process_data import calculate_metrics, calculate_segmented_metrics, update_last_action_and_purchase_dates
+from routes.integration_routes import save_customers, save_transactions, save_events, SAVE_BATCH_SIZE
+
+EVENT_TYPES = ['BROWSE', 'visit', 'MAIL_OPEN', 'MAIL_CLICK', 'BASKET_ADD', 'ORDER_SHIPPED']
+EVENT_TYPE_WEIGHTS = [50, 20, 15, 5, 7, 3]
+GENDERS = ['male', 'female', 'other', None]
+LANGUAGES = ['fi', 'sv', 'en', 'de', 'et', None]
+
+
+class SyntheticTenant:
+    """Deterministic generator of Custobar API records for one tenant.
+
+    Segment values are drawn from pools of the given cardinality, and
+    transactions and events are assigned to customers with a Zipf-like skew
+    (`skew` = 0 is uniform), so a few customers are very active and most are
+    not. Records are produced a page at a time from a per-page seed, so the
+    generator itself uses constant memory apart from the customer weights.
+    """
+
+    def __init__(self, customers, transactions, events, cities=200, countries=20, tags=50, mailing_lists=10,
+                 days=730, skew=1.1, seed=42):
+        self.customers = customers
+        self.transactions = transactions
+        self.events = events
+        self.cities = [f"City {index}" for index in range(cities)]
+        self.countries = [f"C{index:02d}" for index in range(countries)]
+        self.tags = [f"tag-{index}" for index in range(tags)]
+        self.mailing_lists = [f"list-{index}" for index in range(mailing_lists)]
+        self.days = days
+        self.seed = seed
+        self.now = datetime(2026, 1, 1)
+        self._customer_weights = list(accumulate(1 / (rank + 1) ** skew for rank in range(customers)))
+
+    def _date(self, rng):
+        return self.now - timedelta(seconds=rng.randrange(self.days * 86400))
+
+    def _customer_ids(self, rng, count):
+        return rng.choices(range(self.customers), cum_weights=self._customer_weights, k=count)
+
+    def _rng(self, kind, start):
+        # Each page has its own seed, so any page can be generated on its own (see mock_custobar)
+        return random.Random(f"{self.seed}:{kind}:{start}")
+
+    def customers_page(self, start, count):
+        rng = self._rng('customers', start)
+        page = []
+        for index in range(start, min(start + count, self.customers)):
+            joined = self._date(rng)
+            page.append({
+                "external_id": f"cust-{index}",
+                "date_joined": joined.strftime("%Y-%m-%dT%H:%M:%S"),
+                "last_modified": joined.isoformat(),
+                "can_email": rng.random() < 0.7,
+                "city": rng.choice(self.cities),
+                "country": rng.choice(self.countries),
+                "gender": rng.choice(GENDERS),
+                "language": rng.choice(LANGUAGES),
+                "tags": rng.sample(self.tags, rng.randint(0, min(3, len(self.tags)))),
+                "mailing_lists": rng.sample(self.mailing_lists, rng.randint(0, min(2, len(self.mailing_lists)))),
+            })
+        return page
+
+    def transactions_page(self, start, count):
+        rng = self._rng('sales', start)
+        count = max(0, min(count, self.transactions - start))
+        return [{
+            "external_id": f"sale-{start + offset}",
+            "customer_id": f"cust-{customer}",
+            "date": self._date(rng).isoformat(),
+            "total": round(rng.lognormvariate(3.5, 0.8), 2),
+            "state": 'complete' if rng.random() < 0.95 else 'cancelled',
+            "products": [f"prod-{rng.randrange(5000)}" for _ in range(rng.randint(1, 4))],
+        } for offset, customer in enumerate(self._customer_ids(rng, count))]
+
+    def events_page(self, start, count):
+        rng = self._rng('events', start)
+        count = max(0, min(count, self.events - start))
+        types = rng.choices(EVENT_TYPES, weights=EVENT_TYPE_WEIGHTS, k=count)
+        return [{
+            "id": f"event-{start + offset}",
+            "customer_id": f"cust-{customer}",
+            "type": event_type,
+            "date": self._date(rng).isoformat(),
+            "path": f"/products/{rng.randrange(5000)}",
+            "utm_source": rng.choice(['newsletter', 'google', None]),
+        } for offset, (customer, event_type) in enumerate(zip(self._customer_ids(rng, count), types))]
+
+    def customer_batches(self, batch_size):
+        for start in range(0, self.customers, batch_size):
+            yield self.customers_page(start, batch_size)
+
+    def transaction_batches(self, batch_size):
+        for start in range(0, self.transactions, batch_size):
+            yield self.transactions_page(start, batch_size)
+
+    def event_batches(self, batch_size):
+        for start in range(0, self.events, batch_size):
+            yield self.events_page(start, batch_size)
+
+
+def _peak_rss_mb():
+    """Highest RSS of the process so far, across all stages that have run."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _current_rss_mb():
+    """Current RSS of the process, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            resident_pages = int(statm.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+
+class RssSampler:
+    """Track the highest RSS seen while a stage runs by polling it from a background thread."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = _current_rss_mb()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='rss-sampler', daemon=True)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, _current_rss_mb())
+
+    def start(self):
+        if self.peak is not None:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling and return the stage's peak RSS in MB, or None if RSS cannot be read."""
+        if self.peak is None:
+            return None
+        self._stopped.set()
+        self._thread.join()
+        return max(self.peak, _current_rss_mb())
+
+
+class StageRunner:
+    """Time pipeline stages, counting the SQL statements each one executes."""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.queries = 0
+        self.results = {}
+        event.listen(db.engine, 'before_cursor_execute', self._count_query)
+
+    def _count_query(self, *args):
+        self.queries += 1
+
+    def run(self, name, rows, stage):
+        """Run `stage()`; `rows` is the number of input rows used for rows/s, or None to use its return value."""
+        queries_before = self.queries
+        if self.trace_memory:
+            tracemalloc.start()
+
+        sampler = RssSampler().start()
+        started = time.perf_counter()
+        result = stage()
+        seconds = time.perf_counter() - started
+        stage_peak_rss = sampler.stop()
+
+        traced_peak = None
+        if self.trace_memory:
+            traced_peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+
+        rows = result if rows is None else rows
+        self.results[name] = {
+            "seconds": round(seconds, 3),
+            "rows": rows,
+            "rows_per_second": round(rows / seconds, 1) if seconds else None,
+            "queries": self.queries - queries_before,
+            # Highest RSS sampled during this stage; ru_maxrss never drops, so the
+            # cumulative figure only shows which stage first pushed the process peak up
+            "stage_peak_rss_mb": round(stage_peak_rss, 1) if stage_peak_rss is not None else None,
+            "cumulative_peak_rss_mb": round(_peak_rss_mb(), 1),
+            "peak_traced_mb": round(traced_peak, 1) if traced_peak is not None else None,
+        }
+        print(f"{name}: {seconds:.2f}s, {rows} rows, {self.results[name]['rows_per_second']} rows/s, "
+              f"{self.results[name]['queries']} queries")
+
+
+def _save_all(save, batches, integration_id):
+    """Feed generated batches through a save_* function, as sync_resource does."""
+    saved = 0
+    for batch in batches:
+        save(batch, integration_id)
+        db.session.expunge_all()
+        saved += len(batch)
+    return saved
+
+
+def run_benchmark(tenant, batch_size=SAVE_BATCH_SIZE, trace_memory=False):
+    """Load `tenant` into the current app's (empty) database and time every stage."""
+    db.create_all()
+    user = User(email='benchmark@example.com', password='benchmark')
+    db.session.add(user)
+    db.session.flush()
+    integration = CustobarIntegration(api_key='benchmark', user_id=user.id)
+    db.session.add(integration)
+    db.session.commit()
+    integration_id = integration.id
+
+    runner = StageRunner(trace_memory)
+    runner.run('save_customers', None,
+               lambda: _save_all(save_customers, tenant.customer_batches(batch_size), integration_id))
+    runner.run('save_transactions', None,
+               lambda: _save_all(save_transactions, tenant.transaction_batches(batch_size), integration_id))
+    runner.run('save_events', None,
+               lambda: _save_all(save_events, tenant.event_batches(batch_size), integration_id))
+
+    # Metric stages read every customer, transaction and event of the tenant
+    scanned = tenant.customers + tenant.transactions + tenant.events
+    runner.run('calculate_metrics', scanned, lambda: calculate_metrics(integration_id))
+    runner.run('calculate_segmented_metrics', scanned, lambda: calculate_segmented_metrics(integration_id))
+    runner.run('update_last_action_and_purchase_dates', scanned,
+               lambda: update_last_action_and_purchase_dates(integration_id))
+    return runner.results
+
+
+def compare(results, baseline):
+    """Print each stage's time against a previous run."""
+    for name, stage in results["stages"].items():
+        previous = baseline.get("stages", {}).get(name)
+        if not previous or not previous["seconds"]:
+            continue
+        change = (stage["seconds"] - previous["seconds"]) / previous["seconds"] * 100
+        print(f"{name}: {previous['seconds']}s -> {stage['seconds']}s ({change:+.1f}%)")
+
+
+@click.command('benchmark')
+@click.option('--customers', type=int, default=10000)
+@click.option('--transactions', type=int, default=100000)
+@click.option('--events', type=int, default=200000)
+@click.option('--cities', type=int, default=200, help='Distinct city values.')
+@click.option('--countries', type=int, default=20, help='Distinct country values.')
+@click.option('--tags', type=int, default=50, help='Distinct tag values.')
+@click.option('--mailing-lists', type=int, default=10, help='Distinct mailing list values.')
+@click.option('--days', type=int, default=730, help='Days of history to spread activity over.')
+@click.option('--skew', type=float, default=1.1, help='Zipf exponent of activity per customer; 0 is uniform.')
+@click.option('--seed', type=int, default=42)
+@click.option('--batch-size', type=int, default=SAVE_BATCH_SIZE, help='Records per save_* call.')
+@click.option('--trace-memory', is_flag=True, help='Measure per-stage Python allocation peaks (slower).')
+@click.option('--database', type=click.Path(), default=None, help='Scratch SQLite file; a temporary file by default.')
+@click.option('--output', type=click.Path(), default=None, help='Results file; benchmark-<timestamp>.json by default.')
+@click.option('--baseline', type=click.File(), default=None, help='Previous results file to compare against.')
+def benchmark_command(customers, transactions, events, cities, countries, tags, mailing_lists, days, skew, seed,
+                      batch_size, trace_memory, database, output, baseline):
+    """Generate a synthetic tenant into a scratch SQLite database and time each pipeline stage."""
+    from app import create_app
+
+    config = {
+        "customers": customers, "transactions": transactions, "events": events, "cities": cities,
+        "countries": countries, "tags": tags, "mailing_lists": mailing_lists, "days": days, "skew": skew,
+        "seed": seed, "batch_size": batch_size,
+    }
+    database = database or os.path.join(tempfile.mkdtemp(prefix='custobar-benchmark-'), 'benchmark.db')
+    if os.path.exists(database):
+        raise click.UsageError(f"{database} already exists; benchmarks need an empty database")
+
+    tenant = SyntheticTenant(customers, transactions, events, cities, countries, tags, mailing_lists, days, skew,
+                             seed)
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.abspath(database)}"})
+    started_at = datetime.utcnow()
+    with app.app_context():
+        stages = run_benchmark(tenant, batch_size, trace_memory)
+
+    results = {"started_at": started_at.isoformat(), "database": database, "config": config, "stages": stages}
+    output = output or f"benchmark-{started_at.strftime('%Y%m%dT%H%M%S')}.json"
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"Results written to {output}")
+
+    if baseline:
+        compare(results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    benchmark_command()
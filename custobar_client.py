@@ -0,0 +1,169 @@
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Custobar API request budget per integration; every resource stream of a sync shares it
+CUSTOBAR_REQUESTS_PER_SECOND = float(os.environ.get("CUSTOBAR_REQUESTS_PER_SECOND", 1))
+CUSTOBAR_BURST = int(os.environ.get("CUSTOBAR_BURST", 3))
+
+# How long to back off after a 429 that carries no usable Retry-After header
+DEFAULT_RETRY_AFTER = 10
+
+# HTTP client settings: (connect, read) timeouts in seconds, retry budget per request
+# and the base/maximum delay for exponential backoff
+CUSTOBAR_CONNECT_TIMEOUT = float(os.environ.get("CUSTOBAR_CONNECT_TIMEOUT", 10))
+CUSTOBAR_READ_TIMEOUT = float(os.environ.get("CUSTOBAR_READ_TIMEOUT", 120))
+CUSTOBAR_MAX_RETRIES = int(os.environ.get("CUSTOBAR_MAX_RETRIES", 5))
+CUSTOBAR_BACKOFF_BASE = float(os.environ.get("CUSTOBAR_BACKOFF_BASE", 1))
+CUSTOBAR_BACKOFF_MAX = float(os.environ.get("CUSTOBAR_BACKOFF_MAX", 60))
+CUSTOBAR_POOL_SIZE = int(os.environ.get("CUSTOBAR_POOL_SIZE", 10))
+
+logger = logging.getLogger(__name__)
+
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class RateLimiter:
+    """Token bucket limiting how often requests may be sent to the Custobar API.
+
+    Tokens refill at `rate` per second up to `burst`. `pause` blocks every caller
+    until a given time, which is how Retry-After responses are honoured.
+    """
+
+    def __init__(self, rate=CUSTOBAR_REQUESTS_PER_SECOND, burst=CUSTOBAR_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent, then consume one token."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """Consume a token if one is available right now; returns whether it was."""
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return False
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds`, e.g. after a 429 response."""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.blocked_until
+
+
+def parse_retry_after(value, default=DEFAULT_RETRY_AFTER):
+    """Convert a Retry-After header (seconds or HTTP date) into seconds to wait."""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt, base=CUSTOBAR_BACKOFF_BASE, cap=CUSTOBAR_BACKOFF_MAX):
+    """Exponential backoff with full jitter for the given (zero-based) retry attempt."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CustobarClient:
+    """HTTP client for one integration's Custobar API calls.
+
+    Wraps a pooled `requests.Session` so connections are kept alive and reused
+    across pages and resource streams, asks for gzip-compressed responses, and
+    retries 429/5xx responses and connection errors with backoff. All requests
+    are paced by a shared RateLimiter.
+    """
+
+    def __init__(self, api_key, rate_limiter=None, timeout=None, max_retries=CUSTOBAR_MAX_RETRIES):
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.timeout = timeout or (CUSTOBAR_CONNECT_TIMEOUT, CUSTOBAR_READ_TIMEOUT)
+        self.max_retries = max_retries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=CUSTOBAR_POOL_SIZE, pool_maxsize=CUSTOBAR_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+        })
+
+    def get(self, url, params=None):
+        """GET `url`, retrying rate limits, server errors and connection failures.
+
+        Returns the final response; callers still check its status code, since a
+        response is returned once retries are exhausted.
+        """
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries:
+                    raise
+                wait = backoff_delay(attempt)
+                logger.warning("Request to %s failed (%s), retrying in %.1fs", url, e, wait)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+                if response.status_code == 429:
+                    # Rate limiting applies to every stream, so pause the shared limiter
+                    wait = parse_retry_after(response.headers.get("Retry-After"), backoff_delay(attempt))
+                    self.rate_limiter.pause(wait)
+                else:
+                    wait = backoff_delay(attempt)
+                logger.warning("Request to %s returned %s, retrying in %.1fs", url, response.status_code, wait)
+
+            attempt += 1
+            time.sleep(wait)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,107 @@
+import hashlib
+import math
+
+# 2^12 registers: about 1.6% standard error
+DEFAULT_PRECISION = 12
+
+# Serialized layouts: every register, or (2-byte index, rank) pairs for the non-zero ones
+_DENSE = 0
+_SPARSE = 1
+
+
+class HyperLogLog:
+    """HyperLogLog distinct-count sketch.
+
+    Sketches of the same precision merge by taking the register-wise maximum,
+    so per-day sketches can be combined into any window or union of segments.
+
+    A sketch starts sparse, as a dict of its non-zero registers, and switches
+    to a dense bytearray once a third of the registers are set. Most per-day,
+    per-segment sketches hold a handful of customers, so adding, merging and
+    serializing them only touches those entries.
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self.size = 1 << precision
+        self.sparse = {}  # register index -> rank, while sparse
+        self.registers = None  # bytearray of every register, once dense
+
+    def _set(self, index, rank):
+        if self.registers is not None:
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+        elif rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+            if len(self.sparse) * 3 >= self.size:
+                self._densify()
+
+    def _densify(self):
+        registers = bytearray(self.size)
+        for index, rank in self.sparse.items():
+            registers[index] = rank
+        self.registers = registers
+        self.sparse = None
+
+    def add(self, value):
+        """Add a value; it is hashed through its string form, so 42 and '42' are the same."""
+        hashed = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+        remaining_bits = 64 - self.precision
+        rank = remaining_bits - (hashed & ((1 << remaining_bits) - 1)).bit_length() + 1
+        self._set(hashed >> remaining_bits, rank)
+
+    def _merge_dense(self, registers):
+        if self.registers is None:
+            self._densify()
+        self.registers = bytearray(map(max, self.registers, registers))
+
+    def merge(self, other):
+        """Fold another sketch into this one, in place."""
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches of different precision")
+        if other.registers is not None:
+            self._merge_dense(other.registers)
+        else:
+            for index, rank in other.sparse.items():
+                self._set(index, rank)
+        return self
+
+    def merge_bytes(self, data):
+        """Fold a serialized sketch into this one without building a second sketch."""
+        if data[0] != self.precision:
+            raise ValueError("Cannot merge sketches of different precision")
+        if data[1] == _DENSE:
+            self._merge_dense(data[2:])
+            return self
+        for offset in range(2, len(data), 3):
+            self._set(int.from_bytes(data[offset:offset + 2], 'big'), data[offset + 2])
+        return self
+
+    def count(self):
+        """Estimate the number of distinct values added."""
+        m = self.size
+        if self.registers is None:
+            zeros = m - len(self.sparse)
+            harmonic_sum = zeros + sum(2.0 ** -rank for rank in self.sparse.values())
+        else:
+            zeros = self.registers.count(0)
+            harmonic_sum = sum(2.0 ** -rank for rank in self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / harmonic_sum
+
+        # Linear counting is more accurate while many registers are still empty
+        if estimate <= 2.5 * m and zeros:
+            return round(m * math.log(m / zeros))
+        return round(estimate)
+
+    def to_bytes(self):
+        if self.registers is None:
+            return bytes([self.precision, _SPARSE]) + b''.join(
+                index.to_bytes(2, 'big') + bytes([rank]) for index, rank in sorted(self.sparse.items()))
+        return bytes([self.precision, _DENSE]) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data[0]).merge_bytes(data)
@@ -0,0 +1,229 @@
+import heapq
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Statements kept per request/job as "slowest", and how often one SELECT may run
+# within a request/job before it is reported as a likely N+1 pattern
+SLOW_QUERY_COUNT = int(os.environ.get("INSTRUMENTATION_SLOW_QUERIES", 5))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get("INSTRUMENTATION_N_PLUS_ONE_THRESHOLD", 20))
+
+# Request query summaries are logged at INFO when a statement took at least this
+# many seconds, otherwise at DEBUG; job summaries are always logged at INFO
+SLOW_QUERY_SECONDS = float(os.environ.get("INSTRUMENTATION_SLOW_QUERY_SECONDS", 1.0))
+
+# An IN (...) list of ten or more values: a deliberately batched lookup, not a per-row query
+_BATCHED_IN = re.compile(r"\bIN\s*\((?:[^()]*,){9,}", re.IGNORECASE)
+
+# name -> (Prometheus type, help text)
+METRICS = {
+    'custobar_db_queries_total': ('counter', 'SQL statements executed, by request endpoint or job kind.'),
+    'custobar_db_query_seconds_total': ('counter', 'Time spent executing SQL statements.'),
+    'custobar_db_slowest_query_seconds': ('gauge', 'Slowest single SQL statement seen.'),
+    'custobar_db_n_plus_one_total': ('counter', 'Requests/jobs that ran a per-row SELECT at least the N+1 threshold.'),
+    'custobar_scope_runs_total': ('counter', 'Finished requests and jobs.'),
+    'custobar_stage_seconds_total': ('counter', 'Time spent per pipeline stage, summed over threads.'),
+    'custobar_stage_runs_total': ('counter', 'Times each pipeline stage ran.'),
+    'custobar_stage_rows_total': ('counter', 'Rows handled per pipeline stage.'),
+}
+
+
+class MetricsRegistry:
+    """Thread-safe counters and gauges rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._values = defaultdict(float)  # (metric, sorted label pairs) -> value
+        self._lock = threading.Lock()
+
+    def inc(self, metric, value=1, **labels):
+        with self._lock:
+            self._values[(metric, tuple(sorted(labels.items())))] += value
+
+    def set_max(self, metric, value, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = max(self._values[key], value)
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+
+        lines = []
+        for name, (metric_type, help_text) in METRICS.items():
+            samples = sorted((labels, value) for (sample_name, labels), value in values.items() if sample_name == name)
+            if not samples:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels)
+                lines.append(f"{name}{{{label_text}}} {value:g}" if label_text else f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _one_line(statement, limit=500):
+    return ' '.join(statement.split())[:limit]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = MetricsRegistry()
+
+
+class QueryStats:
+    """SQL statements executed within one request or job."""
+
+    def __init__(self, scope, name):
+        self.scope = scope
+        self.name = name
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = []  # min-heap of (seconds, statement)
+        self.selects = Counter()
+        self.select_parameters = defaultdict(set)  # statement -> distinct parameter sets, up to the threshold
+
+    def record(self, statement, seconds, parameters=None):
+        self.count += 1
+        self.seconds += seconds
+        if len(self.slowest) < SLOW_QUERY_COUNT:
+            heapq.heappush(self.slowest, (seconds, statement))
+        elif seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, statement))
+        if statement.lstrip()[:6].upper() == 'SELECT' and not _BATCHED_IN.search(statement):
+            self.selects[statement] += 1
+            seen = self.select_parameters[statement]
+            if len(seen) < N_PLUS_ONE_THRESHOLD:
+                seen.add(repr(parameters))
+
+    def repeated_selects(self):
+        """Likely per-row SELECTs, most repeated first.
+
+        A statement counts when it ran at least N_PLUS_ONE_THRESHOLD times with
+        that many different parameter sets. Batched IN (...) lookups and
+        statements re-run with the same parameters (e.g. a cursor read per page)
+        are not per-row queries and are left out.
+        """
+        return [(statement, count) for statement, count in self.selects.most_common()
+                if count >= N_PLUS_ONE_THRESHOLD and len(self.select_parameters[statement]) >= N_PLUS_ONE_THRESHOLD]
+
+    def summary(self):
+        """Counts, time and the slowest statements (SQL on one line), as logging `extra` fields."""
+        return {
+            "scope": self.scope,
+            "scope_name": self.name,
+            "queries": self.count,
+            "db_seconds": round(self.seconds, 3),
+            "slowest": [{"seconds": round(seconds, 4), "statement": _one_line(statement)}
+                        for seconds, statement in sorted(self.slowest, reverse=True)],
+        }
+
+
+_local = threading.local()
+
+
+def current_stats():
+    """Return the QueryStats of the request or job running on this thread, if any."""
+    return getattr(_local, 'stats', None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_started'].pop()
+    stats = current_stats()
+    if stats:
+        stats.record(statement, seconds, None if executemany else parameters)
+    else:
+        registry.inc('custobar_db_queries_total', scope='other', scope_name='')
+        registry.inc('custobar_db_query_seconds_total', seconds, scope='other', scope_name='')
+
+
+def start_tracking(scope, name):
+    _local.stats = QueryStats(scope, name)
+    return _local.stats
+
+
+def finish_tracking():
+    """Fold the thread's QueryStats into the registry and return them (or None)."""
+    stats = current_stats()
+    if stats is None:
+        return None
+    _local.stats = None
+
+    labels = {"scope": stats.scope, "scope_name": stats.name}
+    registry.inc('custobar_scope_runs_total', **labels)
+    registry.inc('custobar_db_queries_total', stats.count, **labels)
+    registry.inc('custobar_db_query_seconds_total', stats.seconds, **labels)
+    if stats.slowest:
+        registry.set_max('custobar_db_slowest_query_seconds', max(stats.slowest)[0], **labels)
+    if stats.repeated_selects():
+        registry.inc('custobar_db_n_plus_one_total', **labels)
+    return stats
+
+
+@contextmanager
+def track(scope, name):
+    """Collect query statistics for the block, e.g. a background job."""
+    stats = start_tracking(scope, name)
+    try:
+        yield stats
+    finally:
+        finish_tracking()
+        _log_summary(stats, logging.INFO)
+
+
+def _log_summary(stats, level):
+    """Log the query summary with its slowest statements, then any likely N+1 SELECTs."""
+    logger.log(level, "Query summary", extra=stats.summary())
+    for statement, count in stats.repeated_selects():
+        logger.warning("Possible N+1: %s x %s", count, _one_line(statement, 200),
+                       extra={"scope": stats.scope, "scope_name": stats.name})
+
+
+def record_stage(name, seconds, rows=0):
+    registry.inc('custobar_stage_seconds_total', seconds, stage=name)
+    registry.inc('custobar_stage_runs_total', stage=name)
+    if rows:
+        registry.inc('custobar_stage_rows_total', rows, stage=name)
+
+
+@contextmanager
+def stage(name, rows=0):
+    """Time a pipeline stage (fetch, parse, save, metrics, segments, last_dates, ...)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started, rows)
+
+
+def init_app(app):
+    """Hook SQL timing into every engine and collect per-request statistics."""
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def _start_request_tracking():
+        start_tracking('request', request.endpoint or '')
+
+    @app.teardown_request
+    def _finish_request_tracking(exc):
+        stats = finish_tracking()
+        if stats:
+            slow = stats.slowest and max(stats.slowest)[0] >= SLOW_QUERY_SECONDS
+            _log_summary(stats, logging.INFO if slow else logging.DEBUG)
@@ -0,0 +1,149 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import click
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+import instrumentation
+from models import db, Job
+
+# Number of jobs that may run at the same time in this process
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+
+_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+logger = logging.getLogger(__name__)
+
+
+class JobProgress:
+    """Progress reporter handed to a job's target function.
+
+    Each call writes straight to the job row with an UPDATE, using the calling
+    thread's session, so it is safe to share between worker threads.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def phase(self, name):
+        """Record the stage the job has moved into."""
+        db.session.query(Job).filter(Job.id == self.job_id).update(
+            {Job.phase: name}, synchronize_session=False)
+        db.session.commit()
+
+    def add(self, count):
+        """Add `count` to the job's processed record total."""
+        if not count:
+            return
+        db.session.query(Job).filter(Job.id == self.job_id).update(
+            {Job.records_processed: Job.records_processed + count}, synchronize_session=False)
+        db.session.commit()
+
+
+class JobConflict(Exception):
+    """A job of the same kind is already queued or running for the integration."""
+
+    def __init__(self, job):
+        super().__init__(f"{job.kind} job {job.id} is already {job.status}")
+        self.job = job
+
+
+def active_job(kind, integration_id):
+    """Return the queued or running job of `kind` for the integration, if any."""
+    return Job.query.filter(
+        Job.kind == kind,
+        Job.custobar_integration_id == integration_id,
+        Job.status.in_(['queued', 'running'])
+    ).first()
+
+
+def enqueue_job(kind, integration_id, target, *args):
+    """Create a queued Job row and run `target(*args, progress=...)` on the worker pool.
+
+    Must be called inside an app context; the job runs in its own context on a
+    worker thread. Returns the Job so the caller can hand its id to the client.
+    Raises JobConflict if a job of the same kind is already queued or running
+    for the integration; a unique index backs this across processes.
+    """
+    existing = active_job(kind, integration_id)
+    if existing:
+        raise JobConflict(existing)
+
+    job = Job(kind=kind, custobar_integration_id=integration_id, status='queued')
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request queued the same job between the check and the insert
+        db.session.rollback()
+        existing = active_job(kind, integration_id)
+        if existing is None:
+            raise
+        raise JobConflict(existing)
+
+    app = current_app._get_current_object()
+    _executor.submit(_run_job, app, job.id, kind, target, args)
+    return job
+
+
+def fail_interrupted_jobs():
+    """Mark jobs left queued or running by a previous process as failed; returns how many.
+
+    Jobs only run on the in-process pool, so after a restart nothing will ever
+    pick them up. Run this once when the server starts, before it serves
+    requests, and not from processes that run alongside a live server.
+    """
+    count = Job.query.filter(Job.status.in_(['queued', 'running'])).update(
+        {Job.status: 'failed', Job.error: 'Interrupted by a restart', Job.finished_at: datetime.utcnow()},
+        synchronize_session=False)
+    db.session.commit()
+    if count:
+        logger.warning("Marked interrupted jobs as failed", extra={"jobs": count})
+    return count
+
+
+@click.command('fail-interrupted-jobs')
+def fail_interrupted_jobs_command():
+    """Mark jobs left queued or running by a stopped server as failed."""
+    print(f"{fail_interrupted_jobs()} interrupted jobs marked as failed")
+
+
+def _run_job(app, job_id, kind, target, args):
+    with app.app_context(), instrumentation.track('job', kind):
+        _set_job_fields(job_id, status='running', started_at=datetime.utcnow())
+        try:
+            target(*args, progress=JobProgress(job_id))
+        except Exception as e:
+            db.session.rollback()
+            logger.exception("Job failed", extra={"job_id": job_id, "kind": kind})
+            _set_job_fields(job_id, status='failed', error=str(e), finished_at=datetime.utcnow())
+        else:
+            _set_job_fields(job_id, status='succeeded', phase=None, finished_at=datetime.utcnow())
+
+
+def _set_job_fields(job_id, **fields):
+    db.session.query(Job).filter(Job.id == job_id).update(fields, synchronize_session=False)
+    db.session.commit()
+
+
+def job_to_dict(job):
+    """Serialize a job with its elapsed time and throughput for the status endpoint."""
+    end = job.finished_at or datetime.utcnow()
+    elapsed = (end - job.started_at).total_seconds() if job.started_at else 0
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "integration_id": job.custobar_integration_id,
+        "status": job.status,
+        "phase": job.phase,
+        "records_processed": job.records_processed,
+        "elapsed_seconds": round(elapsed, 1),
+        "records_per_second": round(job.records_processed / elapsed, 1) if elapsed else 0,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
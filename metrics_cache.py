@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import update
+
+from models import CustobarIntegration
+
+# Entries kept by the in-process cache, and how long each stays valid
+METRICS_CACHE_SIZE = int(os.environ.get("METRICS_CACHE_SIZE", 1024))
+METRICS_CACHE_TTL = int(os.environ.get("METRICS_CACHE_TTL", 3600))
+
+
+class MemoryCache:
+    """Thread-safe in-process LRU cache whose entries expire after `ttl` seconds.
+
+    Any object with the same get(key)/set(key, value) methods can be installed
+    with set_backend(), e.g. a wrapper around a shared Redis instance so web
+    workers share entries. Invalidation does not depend on the backend: keys
+    carry the integration's metrics generation from the database.
+    """
+
+    def __init__(self, max_entries=METRICS_CACHE_SIZE, ttl=METRICS_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_backend = MemoryCache()
+
+
+def set_backend(backend):
+    """Replace the cache backend used for metric responses."""
+    global _backend
+    _backend = backend
+
+
+def cache_key(integration, **params):
+    """Build a key from the integration, its metrics generation and the normalized request parameters.
+
+    The generation lives on the integration row and is bumped in the same
+    transaction that writes its metric rows, so entries go stale as soon as any
+    process (a web worker, compute-metrics, snapshot-metrics) commits new rows.
+    """
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+    return f"metrics:{integration.id}:{integration.metrics_generation}:{digest}"
+
+
+def get(key):
+    """Return the cached (etag, payload) pair for a key, or None."""
+    return _backend.get(key)
+
+
+def store(key, payload):
+    """Cache a JSON-serializable payload under `key` and return (etag, payload)."""
+    etag = hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+    _backend.set(key, (etag, payload))
+    return etag, payload
+
+
+def mark_written(session, integration_id):
+    """Note that metric rows of an integration changed by bumping its metrics generation.
+
+    The bump commits or rolls back together with the rows, so cached responses
+    are never dropped for writes that did not happen.
+    """
+    session.execute(update(CustobarIntegration)
+                    .where(CustobarIntegration.id == integration_id)
+                    .values(metrics_generation=CustobarIntegration.metrics_generation + 1))
@@ -0,0 +1,34 @@
+"""Allow one queued or running job per kind and integration
+
+Revision ID: 3f1c9a7e5d28
+Revises: 0b7f4d2e9a61
+Create Date: 2026-10-17 22:03:51.662409
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a7e5d28'
+down_revision = '0b7f4d2e9a61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Jobs left queued or running by an earlier process can never finish
+    op.execute("""
+        UPDATE jobs SET status = 'failed', error = 'Interrupted by a restart'
+        WHERE status IN ('queued', 'running')
+    """)
+
+    with op.batch_alter_table('jobs', schema=None) as batch_op:
+        batch_op.create_index('uq_jobs_active_kind_integration', ['kind', 'custobar_integration_id'], unique=True,
+                              sqlite_where=sa.text("status IN ('queued', 'running')"),
+                              postgresql_where=sa.text("status IN ('queued', 'running')"))
+
+
+def downgrade():
+    with op.batch_alter_table('jobs', schema=None) as batch_op:
+        batch_op.drop_index('uq_jobs_active_kind_integration')
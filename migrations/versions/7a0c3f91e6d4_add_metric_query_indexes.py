@@ -0,0 +1,44 @@
+"""Add composite indexes for the metric queries
+
+Revision ID: 7a0c3f91e6d4
+Revises: e47c2a58b9d1
+Create Date: 2026-10-17 13:14:02.781926
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a0c3f91e6d4'
+down_revision = 'e47c2a58b9d1'
+branch_labels = None
+depends_on = None
+
+
+# (index name, table, columns), matching the Index definitions in models.py
+INDEXES = [
+    ('ix_customers_integration_signup_date', 'customers', ['custobar_integration_id', 'signup_date']),
+    ('ix_customers_integration_city', 'customers', ['custobar_integration_id', 'city']),
+    ('ix_customers_integration_country', 'customers', ['custobar_integration_id', 'country']),
+    ('ix_customers_integration_gender', 'customers', ['custobar_integration_id', 'gender']),
+    ('ix_customers_integration_language', 'customers', ['custobar_integration_id', 'language']),
+    ('ix_customers_integration_last_login', 'customers', ['custobar_integration_id', 'last_login']),
+    ('ix_transactions_integration_date', 'transactions', ['custobar_integration_id', 'transaction_date']),
+    ('ix_transactions_cb_id_date', 'transactions', ['cb_id', 'transaction_date']),
+    ('ix_events_integration_type_date', 'events', ['custobar_integration_id', 'event_type', 'date']),
+    ('ix_events_cb_id_date', 'events', ['cb_id', 'date']),
+    ('ix_metrics_integration_date', 'metrics', ['custobar_integration_id', 'date']),
+    ('ix_segmented_metrics_integration_date_segment', 'segmented_metrics',
+     ['custobar_integration_id', 'date', 'segment']),
+]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,36 @@
+"""Unique sale_external_id per integration on transactions
+
+Revision ID: 8f3a61c0d2b7
+Revises: 5b1e7d2a9c40
+Create Date: 2026-10-17 10:03:47.552190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f3a61c0d2b7'
+down_revision = '5b1e7d2a9c40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Remove duplicate sales left behind by earlier imports, keeping the first row
+    op.execute("""
+        DELETE FROM transactions
+        WHERE id NOT IN (
+            SELECT MIN(id) FROM transactions
+            GROUP BY custobar_integration_id, sale_external_id
+        )
+    """)
+
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_transactions_integration_sale_external_id',
+                                          ['custobar_integration_id', 'sale_external_id'])
+
+
+def downgrade():
+    with op.batch_alter_table('transactions', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_transactions_integration_sale_external_id', type_='unique')
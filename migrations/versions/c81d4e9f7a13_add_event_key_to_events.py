@@ -0,0 +1,71 @@
+"""Add event_key to events and make it unique per integration
+
+Revision ID: c81d4e9f7a13
+Revises: 8f3a61c0d2b7
+Create Date: 2026-10-17 10:41:09.127734
+
+"""
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81d4e9f7a13'
+down_revision = '8f3a61c0d2b7'
+branch_labels = None
+depends_on = None
+
+
+events = sa.table(
+    'events',
+    sa.column('id', sa.Integer),
+    sa.column('cb_id', sa.String),
+    sa.column('event_type', sa.String),
+    sa.column('date', sa.DateTime),
+    sa.column('path', sa.String),
+    sa.column('event_key', sa.String),
+)
+
+
+def upgrade():
+    with op.batch_alter_table('events', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('event_key', sa.String(length=255), nullable=True))
+
+    # Backfill keys as event_identity would. The events table has kept no Custobar
+    # event id since 37667120c20a dropped events.external_id, so every row gets the
+    # content hash; save_events moves a row to its id: key when the event is
+    # fetched again with an id, instead of inserting it a second time.
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select(events.c.id, events.c.cb_id, events.c.event_type, events.c.date, events.c.path)
+    ).fetchall()
+    updates = []
+    for row in rows:
+        content = "|".join([row.cb_id, row.event_type or "", row.date.isoformat(), row.path or ""])
+        updates.append({"row_id": row.id, "key": "sha256:" + hashlib.sha256(content.encode("utf-8")).hexdigest()})
+    if updates:
+        connection.execute(
+            events.update().where(events.c.id == sa.bindparam('row_id')).values(event_key=sa.bindparam('key')),
+            updates
+        )
+
+    # Drop duplicates created by repeated fetches, keeping the first row
+    op.execute("""
+        DELETE FROM events
+        WHERE id NOT IN (
+            SELECT MIN(id) FROM events
+            GROUP BY custobar_integration_id, event_key
+        )
+    """)
+
+    with op.batch_alter_table('events', schema=None) as batch_op:
+        batch_op.alter_column('event_key', existing_type=sa.String(length=255), nullable=False)
+        batch_op.create_unique_constraint('uq_events_integration_event_key', ['custobar_integration_id', 'event_key'])
+
+
+def downgrade():
+    with op.batch_alter_table('events', schema=None) as batch_op:
+        batch_op.drop_constraint('uq_events_integration_event_key', type_='unique')
+        batch_op.drop_column('event_key')
@@ -0,0 +1,99 @@
+"""Local stand-in for the Custobar data API, for load-testing the sync offline.
+
+Serves /api/data/customers/, /api/data/sales/ and /api/data/events/ from a
+synthetic tenant (see benchmark.SyntheticTenant), paginated with `next_url`,
+with configurable latency, page size and rate limiting. Point the backend at
+it with CUSTOBAR_BASE_URL:
+
+    python mock_custobar.py --port 5050 --customers 100000 --transactions 1000000
+    CUSTOBAR_BASE_URL=http://localhost:5050/api flask run
+"""
+import random
+import time
+from urllib.parse import urlencode
+
+import click
+from flask import Flask, jsonify, request
+
+from benchmark import SyntheticTenant
+from custobar_client import RateLimiter
+
+# Endpoint resource name -> (SyntheticTenant page method, total count attribute)
+MOCK_RESOURCES = {
+    'customers': ('customers_page', 'customers'),
+    'sales': ('transactions_page', 'transactions'),
+    'events': ('events_page', 'events'),
+}
+
+
+def create_mock_app(tenant, max_page_size=1000, latency=0.0, jitter=0.0, rate=None, burst=10,
+                    throttle_probability=0.0, retry_after=1):
+    """Build the mock API app.
+
+    Requests over `rate` per second (token bucket of `burst`) and a random
+    `throttle_probability` share of requests get 429 with Retry-After. Filter
+    parameters such as date__gte are accepted but ignored, since the sync drops
+    records older than its cursor itself.
+    """
+    app = Flask(__name__)
+    limiter = RateLimiter(rate, burst) if rate else None
+
+    @app.route('/api/data/<resource>/', methods=['GET'])
+    def data(resource):
+        if resource not in MOCK_RESOURCES:
+            return jsonify({"message": f"Unknown resource {resource}"}), 404
+        if not request.headers.get('Authorization'):
+            return jsonify({"message": "Authentication credentials were not provided"}), 401
+
+        if latency or jitter:
+            time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+        if (limiter and not limiter.try_acquire()) or random.random() < throttle_probability:
+            response = jsonify({"message": "Request was throttled"})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+
+        page_method, count_attribute = MOCK_RESOURCES[resource]
+        total = getattr(tenant, count_attribute)
+        page_size = min(max_page_size, int(request.args.get('limit', max_page_size)))
+        page = int(request.args.get('page', 1))
+        start = (page - 1) * page_size
+
+        next_url = None
+        if start + page_size < total:
+            next_url = f"{request.base_url}?{urlencode(dict(request.args.items(), page=page + 1))}"
+
+        return jsonify({
+            resource: getattr(tenant, page_method)(start, page_size) if start < total else [],
+            "count": total,
+            "next_url": next_url,
+        })
+
+    return app
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', type=int, default=5050)
+@click.option('--customers', type=int, default=10000)
+@click.option('--transactions', type=int, default=100000)
+@click.option('--events', type=int, default=200000)
+@click.option('--seed', type=int, default=42)
+@click.option('--page-size', type=int, default=1000, help='Largest page served, whatever limit is requested.')
+@click.option('--latency', type=float, default=0.0, help='Seconds added to every response.')
+@click.option('--jitter', type=float, default=0.0, help='Random +/- seconds on top of --latency.')
+@click.option('--rate', type=float, default=None, help='Requests per second before answering 429.')
+@click.option('--burst', type=int, default=10, help='Requests allowed at once under --rate.')
+@click.option('--throttle-probability', type=float, default=0.0, help='Share of requests answered 429 at random.')
+@click.option('--retry-after', type=int, default=1, help='Retry-After seconds sent with 429 responses.')
+def mock_custobar_command(host, port, customers, transactions, events, seed, page_size, latency, jitter, rate,
+                          burst, throttle_probability, retry_after):
+    """Serve a synthetic tenant through a local mock of the Custobar data API."""
+    tenant = SyntheticTenant(customers, transactions, events, seed=seed)
+    app = create_mock_app(tenant, page_size, latency, jitter, rate, burst, throttle_probability, retry_after)
+    app.run(host=host, port=port, threaded=True)
+
+
+if __name__ == "__main__":
+    mock_custobar_command()
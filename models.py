@@ -17,6 +17,8 @@ class CustobarIntegration(db.Model):
     id = db.Column(db.Integer, primary_key=True)  # Integration ID
     api_key = db.Column(db.String(255), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # Bumped whenever metric rows are written; part of every cached metrics response key
+    metrics_generation = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     # Establish relationship between CustobarIntegration and Customer
     customers = relationship('Customer', backref='custobar_integration', lazy=True)
@@ -27,6 +29,15 @@ class CustobarIntegration(db.Model):
 # Customers Table
 class Customer(db.Model):
     __tablename__ = 'customers'
+    __table_args__ = (
+        # Metric queries filter customers by integration, then by signup date or group by a segment column
+        db.Index('ix_customers_integration_signup_date', 'custobar_integration_id', 'signup_date'),
+        db.Index('ix_customers_integration_city', 'custobar_integration_id', 'city'),
+        db.Index('ix_customers_integration_country', 'custobar_integration_id', 'country'),
+        db.Index('ix_customers_integration_gender', 'custobar_integration_id', 'gender'),
+        db.Index('ix_customers_integration_language', 'custobar_integration_id', 'language'),
+        db.Index('ix_customers_integration_last_login', 'custobar_integration_id', 'last_login'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)  # Internal primary key
     cb_id = db.Column(db.String, unique=True, nullable=False)  # Customer's unique identifier from Custobar
@@ -53,10 +64,44 @@ class Customer(db.Model):
 
 
 
+# Customer tag memberships, one row per (customer, tag) from Customer.tags
+class CustomerTag(db.Model):
+    __tablename__ = 'customer_tags'
+    __table_args__ = (
+        db.UniqueConstraint('customer_id', 'tag', name='uq_customer_tags_customer_tag'),
+        db.Index('ix_customer_tags_integration_tag', 'custobar_integration_id', 'tag'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+    custobar_integration_id = db.Column(db.Integer, db.ForeignKey('custobar_integrations.id'), nullable=False)
+    tag = db.Column(db.String(255), nullable=False)
+
+
+# Customer mailing list memberships, one row per (customer, list) from Customer.mailing_lists
+class CustomerMailingList(db.Model):
+    __tablename__ = 'customer_mailing_lists'
+    __table_args__ = (
+        db.UniqueConstraint('customer_id', 'mailing_list', name='uq_customer_mailing_lists_customer_list'),
+        db.Index('ix_customer_mailing_lists_integration_list', 'custobar_integration_id', 'mailing_list'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+    custobar_integration_id = db.Column(db.Integer, db.ForeignKey('custobar_integrations.id'), nullable=False)
+    mailing_list = db.Column(db.String(255), nullable=False)
+
+
 # Transactions Table
 # Transactions Table
 class Transaction(db.Model):
     __tablename__ = 'transactions'
+    __table_args__ = (
+        db.UniqueConstraint('custobar_integration_id', 'sale_external_id',
+                            name='uq_transactions_integration_sale_external_id'),
+        db.Index('ix_transactions_integration_date', 'custobar_integration_id', 'transaction_date'),
+        db.Index('ix_transactions_cb_id_date', 'cb_id', 'transaction_date'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     cb_id = db.Column(db.String, nullable=False)
@@ -74,8 +119,14 @@ class Transaction(db.Model):
 # Event Table (formerly Engagement Table)
 class Event(db.Model):
     __tablename__ = 'events'
+    __table_args__ = (
+        db.UniqueConstraint('custobar_integration_id', 'event_key', name='uq_events_integration_event_key'),
+        db.Index('ix_events_integration_type_date', 'custobar_integration_id', 'event_type', 'date'),
+        db.Index('ix_events_cb_id_date', 'cb_id', 'date'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
+    event_key = db.Column(db.String(255), nullable=False)  # Custobar event id or content hash, see event_identity
     cb_id = db.Column(db.String, nullable=False)  # Customer's ID from the events endpoint
     event_type = db.Column(db.String(50), nullable=False)  # Event type (e.g. visit, subscribe)
     date = db.Column(db.DateTime, nullable=False)  # Event Date
@@ -89,9 +140,88 @@ class Event(db.Model):
     customer = db.relationship('Customer', back_populates='events')
 
 
+# Sync cursor table: how far each resource of an integration has been fetched
+class SyncCursor(db.Model):
+    __tablename__ = 'sync_cursors'
+    __table_args__ = (
+        db.UniqueConstraint('custobar_integration_id', 'resource', name='uq_sync_cursors_integration_resource'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    custobar_integration_id = db.Column(db.Integer, db.ForeignKey('custobar_integrations.id'), nullable=False)
+    resource = db.Column(db.String(50), nullable=False)  # Custobar resource (customers, sales, events)
+    last_seen = db.Column(db.DateTime, nullable=True)  # Newest record timestamp saved so far
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # When the cursor last advanced
+    # Checkpoint of an unfinished sync: the next page to fetch and the newest timestamp saved before it
+    resume_url = db.Column(db.String(2048), nullable=True)
+    checkpoint = db.Column(db.DateTime, nullable=True)
+
+
+# Background job table: fetch_data and populate_metrics runs and their progress
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        # At most one queued or running job of each kind per integration
+        db.Index('uq_jobs_active_kind_integration', 'kind', 'custobar_integration_id', unique=True,
+                 sqlite_where=db.text("status IN ('queued', 'running')"),
+                 postgresql_where=db.text("status IN ('queued', 'running')")),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # fetch_data or populate_metrics
+    custobar_integration_id = db.Column(db.Integer, db.ForeignKey('custobar_integrations.id'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, succeeded, failed
+    phase = db.Column(db.String(50), nullable=True)  # Current stage, e.g. fetch or segmented_metrics
+    records_processed = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+# Daily rollups: per-day partial aggregates of transactions and events, overall and per segment
+class DailyRollup(db.Model):
+    __tablename__ = 'daily_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('custobar_integration_id', 'day', 'segment', name='uq_daily_rollups_integration_day_segment'),
+        db.Index('ix_daily_rollups_integration_segment_day', 'custobar_integration_id', 'segment', 'day'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    custobar_integration_id = db.Column(db.Integer, db.ForeignKey('custobar_integrations.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    segment = db.Column(db.String(255), nullable=False, default='')  # '' for the whole integration, else "field: value"
+    revenue = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+    transactions = db.Column(db.Integer, nullable=False, default=0)
+    visits = db.Column(db.Integer, nullable=False, default=0)  # 'visit' events
+    browse_events = db.Column(db.Integer, nullable=False, default=0)  # 'BROWSE' events
+    mail_opens = db.Column(db.Integer, nullable=False, default=0)
+    mail_clicks = db.Column(db.Integer, nullable=False, default=0)
+    # Serialized HyperLogLog sketches of the customers purchasing / visiting (visit or BROWSE) that day
+    active_customers_sketch = db.Column(db.LargeBinary, nullable=True)
+    visitors_sketch = db.Column(db.LargeBinary, nullable=True)
+
+
+# Highest transaction/event id already folded into the daily rollups, per integration.
+# Relies on ids becoming visible in commit order; see rollups._new_id_range
+class RollupWatermark(db.Model):
+    __tablename__ = 'rollup_watermarks'
+    __table_args__ = (
+        db.UniqueConstraint('custobar_integration_id', 'source', name='uq_rollup_watermarks_integration_source'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    custobar_integration_id = db.Column(db.Integer, db.ForeignKey('custobar_integrations.id'), nullable=False)
+    source = db.Column(db.String(50), nullable=False)  # transactions or events
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+
+
 # Metrics Table
 class Metrics(db.Model):
     __tablename__ = 'metrics'
+    __table_args__ = (
+        db.Index('ix_metrics_integration_date', 'custobar_integration_id', 'date'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     campaign_type = db.Column(db.String(100), nullable=True)  # Can be None if not provided
@@ -109,6 +239,10 @@ class Metrics(db.Model):
     click_rate = db.Column(db.Numeric(5, 2), nullable=True)  # Can be None
     conversion_rate = db.Column(db.Numeric(5, 2), nullable=True)  # Can be None
     opt_outs = db.Column(db.Integer, nullable=True)  # Can be None
+    total_revenue = db.Column(db.Numeric(10, 2), nullable=True)  # Can be None
+    clicks = db.Column(db.Integer, nullable=True)  # Can be None
+    opens = db.Column(db.Integer, nullable=True)  # Can be None
+    transactions = db.Column(db.Integer, nullable=True)  # Can be None
 
     # Foreign key relationship to CustobarIntegration
     custobar_integration_id = db.Column(db.Integer, db.ForeignKey('custobar_integrations.id'), nullable=False)
@@ -119,6 +253,9 @@ class Metrics(db.Model):
 
 class SegmentedMetrics(db.Model):
     __tablename__ = 'segmented_metrics'
+    __table_args__ = (
+        db.Index('ix_segmented_metrics_integration_date_segment', 'custobar_integration_id', 'date', 'segment'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     campaign_type = db.Column(db.String(100), nullable=True)
@@ -1,239 +1,237 @@
 from datetime import datetime, timedelta
-from sqlalchemy import func
-from models import CustobarIntegration, User, Customer, Transaction, db, Event, Metrics
-import traceback
-
-def calculate_metrics(integration_id):
-    lookback = 3000
-    """Calculate and populate the metrics for a given integration."""
-    today = datetime.utcnow().date()  # Get today's date without time
-    start_of_day = today
-
-    print("starting calculation for " + str(today))
-
-    try:
-        # Query for the total active customers (customers who made at least one purchase in the last 30 days)
-        active_customers = db.session.query(func.count(Customer.id)).join(Transaction).filter(
-            Transaction.custobar_integration_id == integration_id,
-            Transaction.transaction_date >= start_of_day - timedelta(days=lookback)  # Active within the last 30 days
-        ).scalar()
-
-        print("active customers done " + str(active_customers))
-
-        # Query for new customers (customers who signed up within the last 30 days)
-        new_customers = db.session.query(func.count(Customer.id)).filter(
-            Customer.custobar_integration_id == integration_id,
-            Customer.signup_date >= start_of_day - timedelta(days=lookback)
-        ).scalar()
-
-        print("new customers done " + str(new_customers))
-
-        # Query for passive customers (total customers - active customers)
-        total_customers = db.session.query(func.count(Customer.id)).filter(
+from sqlalchemy import func, select, update, case, and_
+from models import (CustobarIntegration, User, Customer, Transaction, db, Event, Metrics, SegmentedMetrics,
+                    CustomerTag, CustomerMailingList)
+import metrics_cache
+from instrumentation import stage
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+def metrics_queries(integration_id, cutoff):
+    """Build the three aggregate queries calculate_metrics reads from.
+
+    Kept separate from the calculation so their query plans can be inspected
+    (see query_plans.py).
+    """
+    in_window = Transaction.transaction_date >= cutoff
+    recent = Event.date >= cutoff
+
+    return {
+        # All customers and those who signed up within the lookback
+        "customers": db.session.query(
+            func.count(Customer.id),
+            func.sum(case((Customer.signup_date >= cutoff, 1), else_=0))
+        ).filter(
             Customer.custobar_integration_id == integration_id
-        ).scalar()
-
-        print("total customers done " + str(total_customers))
-
-        passive_customers = total_customers - active_customers
-
-        print("passive customers done " + str(passive_customers))
-
-        # Calculate Average Purchase Revenue per Customer
-        avg_purchase_revenue_per_customer = db.session.query(func.sum(Transaction.revenue)).filter(
-            Transaction.custobar_integration_id == integration_id
-        ).scalar() / total_customers if total_customers else 0
-
-        total_revenue = db.session.query(func.sum(Transaction.revenue)).filter(
+        ),
+        # Revenue and transaction counts, all-time and within the lookback window
+        "transactions": db.session.query(
+            func.sum(Transaction.revenue),
+            func.count(Transaction.id),
+            func.sum(case((in_window, Transaction.revenue), else_=0)),
+            func.sum(case((in_window, 1), else_=0)),
+            func.count(func.distinct(case((in_window, Transaction.cb_id))))
+        ).filter(
             Transaction.custobar_integration_id == integration_id
-        ).scalar()
-
-        print("avg purchase done " + str(avg_purchase_revenue_per_customer))
-
-        # Calculate Average Purchase Revenue per Active Customer
-        avg_purchase_revenue_per_active_customer = db.session.query(func.sum(Transaction.revenue)).filter(
-            Transaction.custobar_integration_id == integration_id,
-            Transaction.transaction_date >= start_of_day - timedelta(days=lookback)
-        ).scalar() / active_customers if active_customers else 0
-
-        print("avg purchase per active done " + str(avg_purchase_revenue_per_active_customer))
-
-        # Calculate Average Purchase Size (average transaction value)
-        avg_purchase_size = db.session.query(func.sum(Transaction.revenue)).filter(
-            Transaction.custobar_integration_id == integration_id
-        ).scalar() / db.session.query(func.count(Transaction.id)).filter(
-            Transaction.custobar_integration_id == integration_id
-        ).scalar() if total_customers else 0
-
-        print("avg purchase size done " + str(avg_purchase_size))
-
-        # Visitors to website from customers (count events with event_type 'visit' from customers)
-        visitors_website_from_customers = db.session.query(func.count(Event.id)).filter(
-            Event.custobar_integration_id == integration_id,
-            Event.event_type == 'visit'
-        ).scalar()
-
-        print("visitors to website done " + str(visitors_website_from_customers))
-
-        # Customer Lifetime Value (Overall)
-        customer_lifetime_value_overall = db.session.query(func.sum(Transaction.revenue)).filter(
-            Transaction.custobar_integration_id == integration_id
-        ).scalar() / total_customers if total_customers else 0
-
-        print("CLV overall done " + str(customer_lifetime_value_overall))
-
-        # Customer Lifetime Value (Active Customers)
-        customer_lifetime_value_active_customers = db.session.query(func.sum(Transaction.revenue)).filter(
-            Transaction.custobar_integration_id == integration_id,
-            Transaction.transaction_date >= start_of_day - timedelta(days=lookback)
-        ).scalar() / active_customers if active_customers else 0
-
-        print("CLV active done " + str(customer_lifetime_value_active_customers))
-
-        # Count the number of MAIL_OPEN events for this segment
-        mail_open_count = db.session.query(func.count(Event.id)).filter(
-            Event.custobar_integration_id == integration_id,
-            Event.event_type == 'MAIL_OPEN',  # Filter for MAIL_OPEN event type
-            Event.date >= start_of_day - timedelta(days=lookback)  # Events in the last 'lookback' days
-        ).scalar() or 0
-
-        # Count the number of MAIL_CLICK events for this segment
-        mail_click_count = db.session.query(func.count(Event.id)).filter(
+        ),
+        # Website visits overall, mail opens and clicks within the lookback
+        "events": db.session.query(
+            func.sum(case((Event.event_type == 'visit', 1), else_=0)),
+            func.sum(case((and_(Event.event_type == 'MAIL_OPEN', recent), 1), else_=0)),
+            func.sum(case((and_(Event.event_type == 'MAIL_CLICK', recent), 1), else_=0))
+        ).filter(
             Event.custobar_integration_id == integration_id,
-            Event.event_type == 'MAIL_CLICK',  # Filter for MAIL_CLICK event type
-            Event.date >= start_of_day - timedelta(days=lookback)  # Events in the last 'lookback' days
-        ).scalar() or 0
-
-        # Number of transactions in the last 30 days
-        num_transactions = db.session.query(func.count(Transaction.id)).select_from(Customer).join(
-            Transaction, Customer.cb_id == Transaction.cb_id).filter(
-            Transaction.custobar_integration_id == integration_id,
-            Transaction.transaction_date >= start_of_day - timedelta(days=lookback)
-        ).scalar() or 1  # Prevent division by zero
-
-        # Placeholder for actual open rate, click rate, conversion rate, opt-out calculation
-        open_rate = 0
-
+            Event.event_type.in_(['visit', 'MAIL_OPEN', 'MAIL_CLICK'])
+        ),
+    }
+
+
+def metrics_row(totals):
+    """Derive the Metrics column values from raw integration totals.
+
+    `totals` holds total_customers, new_customers, active_customers,
+    total_revenue, window_revenue, all_transactions, num_transactions,
+    visitors, mail_open_count and mail_click_count.
+    """
+    total_customers = totals["total_customers"]
+    active_customers = totals["active_customers"]
+    total_revenue = totals["total_revenue"]
+    window_revenue = totals["window_revenue"]
+    all_transactions = totals["all_transactions"]
+    num_transactions = totals["num_transactions"]
+    mail_open_count = totals["mail_open_count"]
+    mail_click_count = totals["mail_click_count"]
+
+    return {
+        "campaign_type": "Email",  # Can be dynamic if you have different campaign types
+        "active_customers": active_customers,
+        "new_customers": totals["new_customers"],
+        # Passive customers (total customers - active customers)
+        "passive_customers": total_customers - active_customers,
+        "total_revenue": total_revenue,
+        # Average Purchase Revenue per Customer and per Active Customer
+        "avg_purchase_revenue_per_customer": total_revenue / total_customers if total_customers else 0,
+        "avg_purchase_revenue_per_active_customer": window_revenue / active_customers if active_customers else 0,
+        # Average Purchase Size (average transaction value)
+        "avg_purchase_size": total_revenue / all_transactions if all_transactions else 0,
+        "visitors_website_from_customers": totals["visitors"],
+        # Customer Lifetime Value (Overall and Active Customers)
+        "customer_lifetime_value_overall": total_revenue / total_customers if total_customers else 0,
+        "customer_lifetime_value_active_customers": window_revenue / active_customers if active_customers else 0,
+        # Placeholder for actual open rate and opt-out calculation
+        "open_rate": 0,
         # Calculate the click rate (MAIL_CLICK / MAIL_OPEN)
-        click_rate = mail_click_count / mail_open_count if mail_open_count != 0 else 0
-
+        "click_rate": mail_click_count / mail_open_count if mail_open_count != 0 else 0,
         # Calculate the conversion rate (Transactions / MAIL_CLICK)
-        conversion_rate = num_transactions / mail_click_count if mail_click_count != 0 else 0
-
-        opt_outs = 0
-
-        # Check if metrics already exist for the date and integration_id
-        existing_metrics = db.session.query(Metrics).filter(
-            Metrics.date == today,
-            Metrics.custobar_integration_id == integration_id
-        ).first()
-
-        if existing_metrics:
-            # If metrics already exist, update the existing row
-            existing_metrics.active_customers = active_customers
-            existing_metrics.new_customers = new_customers
-            existing_metrics.passive_customers = passive_customers
-            existing_metrics.total_revenue = total_revenue
-            existing_metrics.avg_purchase_revenue_per_customer = avg_purchase_revenue_per_customer
-            existing_metrics.avg_purchase_revenue_per_active_customer = avg_purchase_revenue_per_active_customer
-            existing_metrics.avg_purchase_size = avg_purchase_size
-            existing_metrics.visitors_website_from_customers = visitors_website_from_customers
-            existing_metrics.customer_lifetime_value_overall = customer_lifetime_value_overall
-            existing_metrics.customer_lifetime_value_active_customers = customer_lifetime_value_active_customers
-            existing_metrics.open_rate = open_rate
-            existing_metrics.click_rate = click_rate
-            existing_metrics.conversion_rate = conversion_rate
-            existing_metrics.opt_outs = opt_outs
-            existing_metrics.opens = mail_open_count
-            existing_metrics.clicks = mail_click_count
-            existing_metrics.transactions = num_transactions
+        "conversion_rate": num_transactions / mail_click_count if mail_click_count != 0 else 0,
+        "opt_outs": 0,
+        "opens": mail_open_count,
+        "clicks": mail_click_count,
+        "transactions": num_transactions,
+    }
+
+
+def write_metrics(integration_id, today, row):
+    """Update today's Metrics row for the integration, or create it."""
+    # Check if metrics already exist for the date and integration_id
+    existing_metrics = db.session.query(Metrics).filter(
+        Metrics.date == today,
+        Metrics.custobar_integration_id == integration_id
+    ).first()
+
+    if existing_metrics:
+        # If metrics already exist, update the existing row
+        for column, value in row.items():
+            setattr(existing_metrics, column, value)
+    else:
+        # If no existing metrics, create a new record
+        db.session.add(Metrics(date=today, custobar_integration_id=integration_id, **row))
+
+    # Cached metric responses of the integration are dropped when this commits
+    metrics_cache.mark_written(db.session, integration_id)
 
-        else:
-            # If no existing metrics, create a new record
-            metrics = Metrics(
-                campaign_type="Email",  # Can be dynamic if you have different campaign types
-                date=today,  # Use only the date part
-                active_customers=active_customers if active_customers is not None else 0,
-                new_customers=new_customers if new_customers is not None else 0,
-                passive_customers=passive_customers if passive_customers is not None else 0,
-                total_revenue=total_revenue if total_revenue is not None else 0,
-                avg_purchase_revenue_per_customer=avg_purchase_revenue_per_customer if avg_purchase_revenue_per_customer is not None else 0,
-                avg_purchase_revenue_per_active_customer=avg_purchase_revenue_per_active_customer if avg_purchase_revenue_per_active_customer is not None else 0,
-                avg_purchase_size=avg_purchase_size if avg_purchase_size is not None else 0,
-                visitors_website_from_customers=visitors_website_from_customers if visitors_website_from_customers is not None else 0,
-                customer_lifetime_value_overall=customer_lifetime_value_overall if customer_lifetime_value_overall is not None else 0,
-                customer_lifetime_value_active_customers=customer_lifetime_value_active_customers if customer_lifetime_value_active_customers is not None else 0,
-                open_rate=open_rate if open_rate is not None else 0,
-                click_rate=click_rate if click_rate is not None else 0,
-                conversion_rate=conversion_rate if conversion_rate is not None else 0,
-                opt_outs=opt_outs if opt_outs is not None else 0,
-                custobar_integration_id=integration_id,
-                opens=mail_open_count,
-                clicks=mail_click_count,
-                transactions=num_transactions
-            )
-            db.session.add(metrics)
 
-        db.session.commit()
-
-        print("Metrics populated successfully")
-
-    except Exception as e:
-        print(e)
+def calculate_metrics(integration_id):
+    lookback = 3000
+    """Calculate and populate the metrics for a given integration.
 
-    return {"message": "Metrics populated successfully"}
+    All metrics are derived from one conditional-aggregate pass over transactions,
+    one over events and one count over customers, rather than a query per metric.
+    """
+    today = datetime.utcnow().date()  # Get today's date without time
+    start_of_day = today
+    cutoff = start_of_day - timedelta(days=lookback)
 
+    logger.debug("Starting metrics calculation", extra={"integration_id": integration_id, "date": str(today)})
+    started = time.perf_counter()
 
-def update_last_action_and_purchase_dates():
-    """Update the last_purchase_date and last_action_date for all customers."""
     try:
-        # Step 1: Get the most recent transaction date for each customer
-        print("Updating last purchase date for customers")
-
-        # Get all customer `cb_id` values
-        customer_cb_ids = db.session.query(Customer.cb_id).all()
+        queries = metrics_queries(integration_id, cutoff)
+
+        # Customer counts: all customers and those who signed up within the lookback
+        total_customers, new_customers = queries["customers"].one()
+
+        # Transaction aggregates, split into all-time and lookback window
+        total_revenue, all_transactions, window_revenue, num_transactions, active_customers = \
+            queries["transactions"].one()
+
+        # Event aggregates: website visits overall, mail opens and clicks within the lookback
+        visitors, mail_open_count, mail_click_count = queries["events"].one()
+
+        totals = {
+            "total_customers": total_customers or 0,
+            "new_customers": new_customers or 0,
+            "active_customers": active_customers or 0,
+            "total_revenue": total_revenue or 0,
+            "window_revenue": window_revenue or 0,
+            "all_transactions": all_transactions or 0,
+            "num_transactions": num_transactions or 0,
+            "visitors": visitors or 0,
+            "mail_open_count": mail_open_count or 0,
+            "mail_click_count": mail_click_count or 0,
+        }
+
+        write_metrics(integration_id, today, metrics_row(totals))
+        db.session.commit()
 
-        for customer_cb_id in customer_cb_ids:
-            cb_id = customer_cb_id[0]  # Extract customer cb_id from tuple
+        logger.info("Metrics populated", extra={
+            "integration_id": integration_id,
+            "customers": totals["total_customers"],
+            "transactions": totals["all_transactions"],
+            "active_customers": totals["active_customers"],
+            "seconds": round(time.perf_counter() - started, 3),
+        })
 
-            # Get the most recent transaction date for this customer (if any)
-            last_purchase = db.session.query(func.max(Transaction.transaction_date)).filter(
-                Transaction.cb_id == cb_id  # Using cb_id for identification
-            ).scalar()
+        return {"message": "Metrics populated successfully"}
 
-            # Get the most recent event date for this customer (if any)
-            last_action = db.session.query(func.max(Event.date)).filter(
-                Event.cb_id == cb_id  # Using cb_id for identification
-            ).scalar()
+    except Exception:
+        db.session.rollback()
+        logger.exception("Error calculating metrics", extra={"integration_id": integration_id})
 
-            # Fetch the customer object by cb_id
-            customer = Customer.query.filter_by(cb_id=cb_id).first()
+        # Re-raise so job and batch runners record the failure
+        raise
 
-            if customer:
-                # Update the last_purchase_date
-                if last_purchase:
-                    customer.last_purchase_date = last_purchase
 
-                # Update the last_action_date
-                if last_action:
-                    customer.last_action_date = last_action
+def last_dates_statements(integration_id=None):
+    """Build the UPDATEs behind update_last_action_and_purchase_dates, keyed by the column they set.
+
+    Each joins customers to the latest transaction or event date per cb_id,
+    computed once with a grouped aggregate (UPDATE ... FROM). On SQLite this
+    needs version 3.33 or later.
+    """
+    statements = {}
+    for column, model, date_column in (("last_purchase_date", Transaction, Transaction.transaction_date),
+                                       ("last_action_date", Event, Event.date)):
+        latest = select(model.cb_id.label("cb_id"), func.max(date_column).label("latest")).group_by(model.cb_id)
+        statement = update(Customer)
+        if integration_id is not None:
+            latest = latest.where(model.custobar_integration_id == integration_id)
+            statement = statement.where(Customer.custobar_integration_id == integration_id)
+        latest = latest.subquery()
+
+        statements[column] = statement.where(Customer.cb_id == latest.c.cb_id).values(
+            {column: latest.c.latest}
+        ).execution_options(synchronize_session=False)
+    return statements
+
+
+def update_last_action_and_purchase_dates(integration_id=None):
+    """Update the last_purchase_date and last_action_date for customers.
+
+    The latest transaction and event date per cb_id are computed once with a
+    grouped aggregate over each table, and customers are updated by joining
+    to that result, so the cost is one pass over each table instead of a
+    correlated lookup per customer. Customers without transactions or events
+    keep their stored dates. When an integration_id is given only that
+    integration's rows are read and its customers touched. Returns the number
+    of customer rows updated, summed over both dates.
+    """
+    try:
+        started = time.perf_counter()
+        updated = 0
 
-                # Add the updated customer to the session
-                db.session.add(customer)
+        for statement in last_dates_statements(integration_id).values():
+            updated += db.session.execute(statement).rowcount
 
         # Commit the changes
         db.session.commit()
 
-        print("Last purchase and action dates updated for all customers")
+        logger.info("Last purchase and action dates updated", extra={
+            "integration_id": integration_id,
+            "customers": updated,
+            "seconds": round(time.perf_counter() - started, 3),
+        })
 
-    except Exception as e:
-        db.session.rollback()  # Rollback in case of error
-        print(f"Error updating last purchase and action dates: {e}")
+        return updated
 
+    except Exception:
+        db.session.rollback()  # Rollback in case of error
+        logger.exception("Error updating last purchase and action dates", extra={"integration_id": integration_id})
 
-from sqlalchemy import func
-from datetime import datetime, timedelta
-from models import db, Customer, Transaction, Event, SegmentedMetrics
+        # Re-raise so job and batch runners record the failure
+        raise
 
 
 ##todo avg purchase size must be calculated from transactions table.
@@ -241,236 +239,315 @@ from models import db, Customer, Transaction, Event, SegmentedMetrics
 ##todo clv should be calculated for all customers as well
 ##todo must be caculated daily, and  replaced
 
-def calculate_segmented_metrics(integration_id):
-
-    lookback = 3000
-    """Calculate segmented metrics for the given Custobar integration."""
+# Columns on Customer that segmented metrics are grouped by
+SEGMENTATION_FIELDS = ['city', 'country', 'gender', 'language', 'last_login', 'tags', 'mailing_lists']
+
+# JSON list fields, segmented per individual value through their normalized link table
+MULTI_VALUE_SEGMENTS = {
+    'tags': (CustomerTag, 'tag'),
+    'mailing_lists': (CustomerMailingList, 'mailing_list'),
+}
+
+
+def segment_label(value):
+    """Map a raw segment value to the label used in SegmentedMetrics.segment."""
+    return value if value else 'Unknown'
+
+
+def _empty_segment():
+    return {
+        "total_customers": 0,
+        "new_customers": 0,
+        "active_customers": 0,
+        "total_revenue": 0,
+        "num_transactions": 0,
+        "total_revenue_for_clv": 0,
+        "total_customers_for_clv": 0,
+        "visitors": 0,
+        "mail_open_count": 0,
+        "mail_click_count": 0,
+    }
+
+
+def merge_segment_values(segments, value, values):
+    """Add one grouped result row into the per-label accumulator.
+
+    Several raw values (NULL and '') collapse onto the same label, so the
+    grouped counts are summed rather than overwritten.
+    """
+    segment = segments.setdefault(str(segment_label(value)), _empty_segment())
+    for key, amount in values.items():
+        segment[key] += amount or 0
+
+
+def segment_column_for(field):
+    """Return the column holding a segmentation field's individual values."""
+    link = MULTI_VALUE_SEGMENTS.get(field)
+    return getattr(*link) if link else getattr(Customer, field)
+
+
+def query_by_segment(field, *columns):
+    """Start a query over customers that can be grouped by segment_column_for(field).
+
+    Multi-valued fields are outer joined to their link table; customers without
+    any values fall into the NULL ('Unknown') segment.
+    """
+    query = db.session.query(*columns).select_from(Customer)
+    link = MULTI_VALUE_SEGMENTS.get(field)
+    if link:
+        query = query.outerjoin(link[0], link[0].customer_id == Customer.id)
+    return query
+
+
+def segment_queries(integration_id, field, cutoff):
+    """Build the grouped queries behind one segmentation field's metrics.
+
+    Each query returns one row per raw segment value: customer counts, purchase
+    aggregates (customers joined to transactions) and event counts (customers
+    joined to events). Multi-valued fields are grouped per individual value
+    through their link table, so a customer counts towards each of its tags.
+    """
+    segment_column = segment_column_for(field)
+    in_window = Transaction.transaction_date >= cutoff
+
+    return {
+        # Customer counts per segment
+        "customers": query_by_segment(
+            field,
+            segment_column,
+            func.count(Customer.id),
+            func.sum(case((Customer.signup_date >= cutoff, 1), else_=0))
+        ).filter(
+            Customer.custobar_integration_id == integration_id
+        ).group_by(segment_column),
+        # Revenue, transaction and purchasing customer counts per segment
+        "transactions": query_by_segment(
+            field,
+            segment_column,
+            func.count(func.distinct(case((in_window, Customer.id)))),
+            func.sum(case((in_window, Transaction.revenue), else_=0)),
+            func.sum(case((in_window, 1), else_=0)),
+            func.sum(Transaction.revenue),
+            func.count(func.distinct(Customer.id))
+        ).join(
+            Transaction, Customer.cb_id == Transaction.cb_id
+        ).filter(
+            Transaction.custobar_integration_id == integration_id
+        ).group_by(segment_column),
+        # Browse and mail event counts per segment
+        "events": query_by_segment(
+            field,
+            segment_column,
+            func.sum(case((Event.event_type == 'BROWSE', 1), else_=0)),
+            func.sum(case((Event.event_type == 'MAIL_OPEN', 1), else_=0)),
+            func.sum(case((Event.event_type == 'MAIL_CLICK', 1), else_=0))
+        ).join(
+            Event, Customer.cb_id == Event.cb_id
+        ).filter(
+            Event.custobar_integration_id == integration_id,
+            Event.event_type.in_(['BROWSE', 'MAIL_OPEN', 'MAIL_CLICK']),
+            Event.date >= cutoff
+        ).group_by(segment_column),
+    }
+
+
+def _segment_aggregates(integration_id, field, cutoff):
+    """Compute the raw per-segment aggregates for one segmentation field.
+
+    Runs the three grouped queries from segment_queries instead of one query
+    per metric per segment value.
+    """
+    queries = segment_queries(integration_id, field, cutoff)
+    segments = {}
+
+    for value, total_customers, new_customers in queries["customers"].all():
+        merge_segment_values(segments, value, {
+            "total_customers": total_customers,
+            "new_customers": new_customers,
+        })
+
+    for value, active, revenue, transactions, revenue_all, purchasers in queries["transactions"].all():
+        merge_segment_values(segments, value, {
+            "active_customers": active,
+            "total_revenue": revenue,
+            "num_transactions": transactions,
+            "total_revenue_for_clv": revenue_all,
+            "total_customers_for_clv": purchasers,
+        })
+
+    for value, visitors, opens, clicks in queries["events"].all():
+        merge_segment_values(segments, value, {
+            "visitors": visitors,
+            "mail_open_count": opens,
+            "mail_click_count": clicks,
+        })
+
+    return segments
+
+
+def segment_metrics_row(field, label, segment):
+    """Derive the SegmentedMetrics column values from the raw segment aggregates."""
+    active_customers = segment["active_customers"]
+    total_customers = segment["total_customers"]
+    total_revenue = segment["total_revenue"]
+    num_transactions = segment["num_transactions"]
+    mail_open_count = segment["mail_open_count"]
+    mail_click_count = segment["mail_click_count"]
+
+    return {
+        "campaign_type": "Email",  # Can be dynamic if you have different campaign types
+        "segment": f"{field}: {label}",
+        "active_customers": active_customers,
+        "new_customers": segment["new_customers"],
+        "passive_customers": total_customers - active_customers,
+        "total_revenue": total_revenue,
+        "avg_purchase_revenue_per_customer": total_revenue / total_customers if total_customers else 0,
+        "avg_purchase_revenue_per_active_customer": total_revenue / active_customers if active_customers else 0,
+        "avg_purchase_size": total_revenue / num_transactions if num_transactions else 0,
+        "visitors_website_from_customers": segment["visitors"],
+        "customer_lifetime_value_overall": segment["total_revenue_for_clv"] / segment["total_customers_for_clv"]
+        if segment["total_customers_for_clv"] else 0,
+        "customer_lifetime_value_active_customers": total_revenue / active_customers if active_customers else 0,
+        # Placeholder for actual open rate and opt-out calculation
+        "open_rate": 0,
+        # Calculate the click rate (MAIL_CLICK / MAIL_OPEN)
+        "click_rate": mail_click_count / mail_open_count if mail_open_count != 0 else 0,
+        # Calculate the conversion rate (Transactions / MAIL_CLICK)
+        "conversion_rate": num_transactions / mail_click_count if mail_click_count != 0 else 0,
+        "opt_outs": 0,
+        "opens": mail_open_count,
+        "clicks": mail_click_count,
+        "transactions": num_transactions,
+    }
+
+
+def write_segmented_metrics(integration_id, today, rows):
+    """Insert or update today's SegmentedMetrics rows in bulk.
+
+    Existing rows are looked up with a single query and matched on the segment
+    label, then written with bulk update/insert mappings.
+    """
+    existing_ids = dict(db.session.query(SegmentedMetrics.segment, SegmentedMetrics.id).filter(
+        SegmentedMetrics.date == today,
+        SegmentedMetrics.custobar_integration_id == integration_id,
+        SegmentedMetrics.segment.in_([row["segment"] for row in rows])
+    ).all()) if rows else {}
+
+    updates = []
+    inserts = []
+    for row in rows:
+        if row["segment"] in existing_ids:
+            updates.append(dict(row, id=existing_ids[row["segment"]]))
+        else:
+            inserts.append(dict(row, date=today, custobar_integration_id=integration_id))
 
-    print("Entered segmented metrics function")
+    if updates:
+        db.session.bulk_update_mappings(SegmentedMetrics, updates)
+    if inserts:
+        db.session.bulk_insert_mappings(SegmentedMetrics, inserts)
 
-    today = datetime.utcnow().date()  # Get today's date without time
-    start_of_day = today
+    metrics_cache.mark_written(db.session, integration_id)
 
-    # Define the segmentation fields
-    # Define the segmentation fields
-    segmentation_fields = ['city', 'country', 'gender', 'language', 'last_login', 'tags', 'mailing_lists']
 
-    try:
-        # Loop through each segmentation field and calculate the metrics
-        for field in segmentation_fields:
-            print(f"Calculating metrics for field in segmentation fields: {field}")
+def calculate_segmented_metrics(integration_id, fields=None):
 
-            # Get the distinct values for the current segmentation field
-            segment_values = db.session.query(getattr(Customer, field)).distinct().all()
+    lookback = 3000
+    """Calculate segmented metrics for the given Custobar integration.
 
-            for value in segment_values:
-                # Convert the tuple to a simple value
+    `fields` limits the run to some of SEGMENTATION_FIELDS; by default all are computed.
+    """
 
-                try:
-                    print("Calculating metrics for segment value " + str(value[0]))
-                    segment_value = value[0] if value[0] else 'Unknown'
+    started = time.perf_counter()
 
-                except TypeError as e:
+    today = datetime.utcnow().date()  # Get today's date without time
+    start_of_day = today
+    cutoff = start_of_day - timedelta(days=lookback)
 
-                    print("error in segement value " + str(e))
-                    segment_value = 'None'
+    segments_written = 0
 
-                # Calculate the metrics for the segment
-                active_customers = db.session.query(func.count(Customer.id)).select_from(Customer).join(
-                    Transaction, Customer.cb_id == Transaction.cb_id).filter(
-                    Transaction.custobar_integration_id == integration_id,
-                    getattr(Customer, field) == segment_value,
-                    Transaction.transaction_date >= start_of_day - timedelta(days=lookback)
-                ).scalar() or 0
+    try:
+        # Each field is computed with a fixed number of grouped queries, regardless
+        # of how many distinct values it has
+        for field in fields or SEGMENTATION_FIELDS:
+            logger.debug("Calculating segmented metrics", extra={"integration_id": integration_id, "field": field})
 
-                print("Active customers: " + str(active_customers))
+            segments = _segment_aggregates(integration_id, field, cutoff)
+            rows = [segment_metrics_row(field, label, segment) for label, segment in segments.items()]
 
-                # For new_customers (No need to join Transaction, just filter by signup_date)
-                new_customers = db.session.query(func.count(Customer.id)).filter(
-                    Customer.custobar_integration_id == integration_id,
-                    getattr(Customer, field) == segment_value,
-                    Customer.signup_date >= start_of_day - timedelta(days=lookback)
-                    # New customers in the last 'lookback' days
-                ).scalar() or 0
-
-                print("New customers: " + str(new_customers))
-
-                # For total_customers
-                # For total_customers (No need to join Transaction, just count customers in the segment)
-                total_customers = db.session.query(func.count(Customer.id)).filter(
-                    Customer.custobar_integration_id == integration_id,
-                    getattr(Customer, field) == segment_value
-                ).scalar() or 0
-
-                print("Total customers: " + str(total_customers))
-
-                print("Made it to passive customers")
-
-                passive_customers = total_customers - active_customers
-
-                print("Passive customers: " + str(passive_customers))
-
-                # Calculate Average Purchase Size (total revenue / number of purchases)
-                # Calculate Average Purchase Size (total revenue / number of purchases)
-                # Sum of revenue divided by the number of transactions (not number of customers)
-                total_revenue_for_segment = db.session.query(func.sum(Transaction.revenue)).select_from(Customer).join(
-                    Transaction, Customer.cb_id == Transaction.cb_id).filter(
-                    Transaction.custobar_integration_id == integration_id,
-                    getattr(Customer, field) == segment_value,
-                    Transaction.transaction_date >= start_of_day - timedelta(days=lookback)
-                ).scalar() or 0
-
-                print("total_revenue_for_segment: " + str(total_revenue_for_segment))
-
-                # Number of transactions in the last 30 days
-                num_transactions = db.session.query(func.count(Transaction.id)).select_from(Customer).join(
-                    Transaction, Customer.cb_id == Transaction.cb_id).filter(
-                    Transaction.custobar_integration_id == integration_id,
-                    getattr(Customer, field) == segment_value,
-                    Transaction.transaction_date >= start_of_day - timedelta(days=lookback)
-                ).scalar() or 1  # Prevent division by zero
-
-                print("num_transactions: " + str(num_transactions))
-
-                avg_purchase_revenue_per_transaction = total_revenue_for_segment / num_transactions or 0
-
-                print("avg_purchase_size: " + str(avg_purchase_revenue_per_transaction))
-
-                print("total_revenue_for_segment: " + str(total_revenue_for_segment))
-
-                avg_purchase_revenue_per_customer = total_revenue_for_segment / total_customers if total_customers else 0
-                print("avg_purchase_revenue_per_customer: " + str(avg_purchase_revenue_per_customer))
-
-                avg_purchase_revenue_per_active_customer = (total_revenue_for_segment / active_customers) if active_customers else 0
-                print("avg_purchase_revenue_per_active_customer: " + str(avg_purchase_revenue_per_active_customer))
-
-                # Calculate Customer Lifetime Value (Overall) (total revenue / total customers in the period)
-                total_revenue_for_clv = db.session.query(func.sum(Transaction.revenue)).select_from(Customer).join(
-                    Transaction, Customer.cb_id == Transaction.cb_id).filter(
-                    Transaction.custobar_integration_id == integration_id,
-                    getattr(Customer, field) == segment_value
-                ).scalar() or 0
-
-                # Count total customers who had at least one transaction
-                total_customers_for_clv = db.session.query(func.count(Customer.id)).select_from(Customer).join(
-                    Transaction, Customer.cb_id == Transaction.cb_id).filter(
-                    Transaction.custobar_integration_id == integration_id,
-                    getattr(Customer, field) == segment_value
-                ).scalar() or 1  # Prevent division by zero
-
-                customer_lifetime_value_overall = total_revenue_for_clv / total_customers_for_clv
-
-                print("Made it to customer_lifetime_value_active_customers")
-
-                # Calculate Customer Lifetime Value (Active Customers) (total revenue / active customers)
-                customer_lifetime_value_active_customers = db.session.query(func.sum(Transaction.revenue)).select_from(
-                    Customer).join(
-                    Transaction, Customer.cb_id == Transaction.cb_id).filter(
-                    Transaction.custobar_integration_id == integration_id,
-                    getattr(Customer, field) == segment_value,
-                    Transaction.transaction_date >= start_of_day - timedelta(days=lookback)
-                ).scalar() or 0
-
-                # Calculate Customer Lifetime Value (Active Customers)
-                customer_lifetime_value_active_customers = customer_lifetime_value_active_customers / active_customers if active_customers else 0
-
-                print("Made it to visitors_website_from_customers")
-
-                # Calculate Visitors to Website (unique BROWSE events in the last 30 days)
-                visitors_website_from_customers = db.session.query(func.count(Event.id.distinct())).filter(
-                    Event.custobar_integration_id == integration_id,
-                    Event.event_type == 'BROWSE',
-                    getattr(Customer, field) == segment_value,
-                    Event.date >= start_of_day - timedelta(days=lookback)
-                ).scalar() or 0
-
-                # Count the number of MAIL_OPEN events for this segment
-                mail_open_count = db.session.query(func.count(Event.id)).filter(
-                    Event.custobar_integration_id == integration_id,
-                    Event.event_type == 'MAIL_OPEN',  # Filter for MAIL_OPEN event type
-                    getattr(Customer, field) == segment_value,
-                    Event.date >= start_of_day - timedelta(days=lookback)  # Events in the last 'lookback' days
-                ).scalar() or 0
-
-                # Count the number of MAIL_CLICK events for this segment
-                mail_click_count = db.session.query(func.count(Event.id)).filter(
-                    Event.custobar_integration_id == integration_id,
-                    Event.event_type == 'MAIL_CLICK',  # Filter for MAIL_CLICK event type
-                    getattr(Customer, field) == segment_value,
-                    Event.date >= start_of_day - timedelta(days=lookback)  # Events in the last 'lookback' days
-                ).scalar() or 0
-
-                # Placeholder for actual open rate, click rate, conversion rate, opt-out calculation
-                open_rate = 0
-                # Calculate the click rate (MAIL_CLICK / MAIL_OPEN)
-                click_rate = mail_click_count / mail_open_count if mail_open_count != 0 else 0
-
-                # Calculate the conversion rate (Transactions / MAIL_CLICK)
-                conversion_rate = num_transactions / mail_click_count if mail_click_count != 0 else 0
-                opt_outs = 0
-
-                # Check if metrics already exist for this segment, date, and custobar_integration_id
-                existing_metrics = db.session.query(SegmentedMetrics).filter(
-                    SegmentedMetrics.date == today,
-                    SegmentedMetrics.segment == f"{field}: {segment_value}",
-                    SegmentedMetrics.custobar_integration_id == integration_id
-                ).first()
-
-                # If metrics exist, update them; otherwise, create a new one
-                if existing_metrics:
-                    existing_metrics.active_customers = active_customers
-                    existing_metrics.new_customers = new_customers
-                    existing_metrics.passive_customers = passive_customers
-                    existing_metrics.total_revenue = total_revenue_for_segment
-                    existing_metrics.avg_purchase_revenue_per_customer = avg_purchase_revenue_per_customer
-                    existing_metrics.avg_purchase_revenue_per_active_customer = avg_purchase_revenue_per_active_customer
-                    existing_metrics.avg_purchase_size = avg_purchase_revenue_per_transaction
-                    existing_metrics.visitors_website_from_customers = visitors_website_from_customers
-                    existing_metrics.customer_lifetime_value_overall = customer_lifetime_value_overall
-                    existing_metrics.customer_lifetime_value_active_customers = customer_lifetime_value_active_customers
-                    existing_metrics.open_rate = open_rate
-                    existing_metrics.click_rate = click_rate
-                    existing_metrics.conversion_rate = conversion_rate
-                    existing_metrics.opt_outs = opt_outs
-                    existing_metrics.opens = mail_open_count
-                    existing_metrics.clicks = mail_click_count
-                    existing_metrics.transactions = num_transactions
-
-                else:
-                    segmented_metrics = SegmentedMetrics(
-                        campaign_type="Email",  # Can be dynamic if you have different campaign types
-                        date=today,
-                        segment=f"{field}: {segment_value}",
-                        active_customers=active_customers,
-                        new_customers=new_customers,
-                        passive_customers=passive_customers,
-                        total_revenue=total_revenue_for_segment,
-                        avg_purchase_revenue_per_customer=avg_purchase_revenue_per_customer,
-                        avg_purchase_revenue_per_active_customer=avg_purchase_revenue_per_active_customer,
-                        avg_purchase_size=avg_purchase_revenue_per_transaction,
-                        visitors_website_from_customers=visitors_website_from_customers,
-                        customer_lifetime_value_overall=customer_lifetime_value_overall,
-                        customer_lifetime_value_active_customers=customer_lifetime_value_active_customers,
-                        open_rate=open_rate,
-                        click_rate=click_rate,
-                        conversion_rate=conversion_rate,
-                        opt_outs=opt_outs,
-                        custobar_integration_id=integration_id,
-                        opens=mail_open_count,
-                        clicks=mail_click_count,
-                        transactions=num_transactions
-                    )
-                    db.session.add(segmented_metrics)
+            write_segmented_metrics(integration_id, today, rows)
 
             # Commit the changes
             db.session.commit()
-            print(f"Metrics for {field} segment populated successfully")
+            segments_written += len(rows)
 
-    except Exception as e:
-        # Log the full traceback to the console
-        print(f"Error calculating segmented metrics: {str(e)}")
-        print(traceback.format_exc())  # Print the traceback for detailed error context
+        logger.info("Segmented metrics populated", extra={
+            "integration_id": integration_id,
+            "segments": segments_written,
+            "seconds": round(time.perf_counter() - started, 3),
+        })
+        return segments_written
+
+    except Exception:
+        logger.exception("Error calculating segmented metrics", extra={"integration_id": integration_id})
 
         # Re-raise the error so Flask can send it to the client
         raise
 
+
+def run_populate_metrics(integration_id, incremental=False, progress=None):
+    """Compute metrics, segmented metrics and last action/purchase dates for an integration.
+
+    Used as the populate_metrics job target; `progress` receives the current
+    phase and the number of rows written by each step. With `incremental`, new
+    transactions and events are folded into the daily rollups and the metrics
+    are answered from those instead of rescanning the full history.
+    """
+    if incremental:
+        return _run_populate_metrics_from_rollups(integration_id, progress)
+
+    if progress:
+        progress.phase('metrics')
+    with stage('metrics'):
+        calculate_metrics(integration_id)
+
+    if progress:
+        progress.add(1)
+        progress.phase('segmented_metrics')
+    with stage('segments'):
+        segments_written = calculate_segmented_metrics(integration_id)
+
+    if progress:
+        progress.add(segments_written)
+        progress.phase('last_dates')
+    with stage('last_dates'):
+        customers_updated = update_last_action_and_purchase_dates(integration_id)
+
+    if progress:
+        progress.add(customers_updated)
+
+
+def _run_populate_metrics_from_rollups(integration_id, progress=None):
+    from rollups import update_rollups, calculate_metrics_from_rollups
+
+    # Active customers are read from last_purchase_date, so refresh it first
+    if progress:
+        progress.phase('last_dates')
+    with stage('last_dates'):
+        customers_updated = update_last_action_and_purchase_dates(integration_id)
+
+    if progress:
+        progress.add(customers_updated)
+        progress.phase('rollups')
+    with stage('rollups'):
+        rows_rolled_up = update_rollups(integration_id)
+
+    if progress:
+        progress.add(rows_rolled_up)
+        progress.phase('metrics')
+    with stage('metrics'):
+        segments_written = calculate_metrics_from_rollups(integration_id)
+    logger.info("Metrics calculated from rollups", extra={"integration_id": integration_id,
+                                                          "segments": segments_written})
+
+    if progress:
+        progress.add(segments_written + 1)
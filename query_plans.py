@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+
+import click
+
+from models import db
+from process_data import metrics_queries, segment_queries, last_dates_statements, SEGMENTATION_FIELDS
+
+# Plan fragments that mean a table is read in full rather than through an index
+FULL_SCAN_MARKERS = {
+    "sqlite": lambda detail: detail.startswith("SCAN") and "USING" not in detail,
+    "postgresql": lambda detail: "Seq Scan" in detail,
+}
+
+
+def explain(query):
+    """Return the database's query plan for a Query or Core statement as a list of text lines."""
+    connection = db.session.connection()
+    dialect = connection.dialect
+    statement = getattr(query, "statement", query)
+    # Render expanding IN (...) binds, which are otherwise left as POSTCOMPILE placeholders
+    compiled = statement.compile(dialect=dialect, compile_kwargs={"render_postcompile": True})
+    if compiled.positional:
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+    else:
+        params = compiled.params
+
+    if dialect.name == "sqlite":
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).fetchall()
+        return [row[-1] for row in rows]
+    rows = connection.exec_driver_sql(f"EXPLAIN {compiled}", params).fetchall()
+    return [row[0] for row in rows]
+
+
+def full_scans(plan, dialect_name):
+    """Return the plan lines that read a table without using an index."""
+    is_full_scan = FULL_SCAN_MARKERS.get(dialect_name)
+    if not is_full_scan:
+        return []
+    # Reading back a materialized subquery (e.g. the grouped maxima of the last-dates UPDATE) is not a table scan
+    materialized = {line.split()[1] for line in plan if line.startswith("MATERIALIZE ")}
+    return [line for line in plan if is_full_scan(line) and line.split()[1] not in materialized]
+
+
+def check_metric_query_plans(integration_id, lookback=3000):
+    """EXPLAIN every metric, segment and last-dates query and collect the ones that do full scans.
+
+    Returns a dict of query name to the offending plan lines; empty when every
+    query is served by an index.
+    """
+    cutoff = datetime.utcnow().date() - timedelta(days=lookback)
+    dialect_name = db.session.get_bind().dialect.name
+
+    queries = {f"metrics.{name}": query for name, query in metrics_queries(integration_id, cutoff).items()}
+    for field in SEGMENTATION_FIELDS:
+        for name, query in segment_queries(integration_id, field, cutoff).items():
+            queries[f"segments.{field}.{name}"] = query
+    for column, statement in last_dates_statements(integration_id).items():
+        queries[f"last_dates.{column}"] = statement
+
+    problems = {}
+    for name, query in queries.items():
+        plan = explain(query)
+        print(f"{name}:")
+        for line in plan:
+            print(f"    {line}")
+        scans = full_scans(plan, dialect_name)
+        if scans:
+            problems[name] = scans
+    return problems
+
+
+@click.command('explain-metrics')
+@click.option('--integration', 'integration_id', type=int, required=True, help='Integration id to plan queries for.')
+def explain_metrics_command(integration_id):
+    """Show query plans for the metric queries and flag full table scans."""
+    problems = check_metric_query_plans(integration_id)
+    if problems:
+        print(f"{len(problems)} queries scan a table without an index:")
+        for name, scans in problems.items():
+            print(f"    {name}: {'; '.join(scans)}")
+        raise SystemExit(1)
+    print("All metric queries use indexes")
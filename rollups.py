@@ -0,0 +1,323 @@
+import logging
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, case, select
+
+from hyperloglog import HyperLogLog
+from models import db, Customer, Transaction, Event, DailyRollup, RollupWatermark
+from process_data import (SEGMENTATION_FIELDS, segment_label, merge_segment_values, segment_column_for,
+                          query_by_segment, metrics_row, write_metrics, segment_metrics_row,
+                          write_segmented_metrics)
+
+logger = logging.getLogger(__name__)
+
+# DailyRollup.segment value for the integration-wide rollup
+OVERALL_SEGMENT = ''
+
+# Days per IN (...) lookup when merging deltas into existing rollup rows
+ROLLUP_DAY_BATCH_SIZE = 200
+
+ROLLUP_COUNTERS = ['revenue', 'transactions', 'visits', 'browse_events', 'mail_opens', 'mail_clicks']
+
+
+def _as_date(value):
+    """func.date() comes back as a string on SQLite and a date elsewhere."""
+    return value if isinstance(value, date) else date.fromisoformat(value)
+
+
+def _add_delta(deltas, day, segment, **amounts):
+    delta = deltas.setdefault((_as_date(day), segment), dict.fromkeys(ROLLUP_COUNTERS, 0))
+    for key, amount in amounts.items():
+        delta[key] += amount or 0
+
+
+# First key of the PostgreSQL advisory locks that keep rollups and ingestion of an
+# integration apart; the second key is the integration id
+ROLLUP_LOCK_NAMESPACE = 16
+
+
+def _advisory_xact_lock(integration_id, shared):
+    """Take the integration's rollup lock until the current transaction ends (PostgreSQL only).
+
+    SQLite runs one writer at a time, so it needs no lock.
+    """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    lock = func.pg_advisory_xact_lock_shared if shared else func.pg_advisory_xact_lock
+    db.session.execute(select(lock(ROLLUP_LOCK_NAMESPACE, integration_id)))
+
+
+def lock_against_rollups(integration_id):
+    """Hold off update_rollups for the integration until the caller's transaction commits.
+
+    Call before inserting transactions or events. Ingestion transactions share
+    the lock with each other; update_rollups takes it exclusively.
+    """
+    _advisory_xact_lock(integration_id, shared=True)
+
+
+def _new_id_range(model, integration_id, source):
+    """Return (watermark row, last rolled-up id, highest new id) for a source table.
+
+    Rows are picked up by `id > watermark`, which is only safe if every id at
+    or below the highest one seen is already committed. SQLite guarantees this
+    with its single writer. On PostgreSQL an insert that allocated a lower id
+    can commit later, so the highest id is read under the exclusive rollup
+    lock: it waits for in-flight ingestion transactions of the integration
+    (see lock_against_rollups), and any later insert gets a higher id.
+    """
+    _advisory_xact_lock(integration_id, shared=False)
+    watermark = RollupWatermark.query.filter_by(custobar_integration_id=integration_id, source=source).first()
+    last_id = watermark.last_id if watermark else 0
+    max_id = db.session.query(func.max(model.id)).filter(
+        model.custobar_integration_id == integration_id,
+        model.id > last_id
+    ).scalar()
+    return watermark, last_id, max_id
+
+
+def _grouped_deltas(deltas, model, day, integration_id, low, high, aggregates, names, filters=()):
+    """Group the rows with low < id <= high by day, overall and per segment, into `deltas`."""
+    new_rows = [model.custobar_integration_id == integration_id, model.id > low, model.id <= high, *filters]
+
+    for row in db.session.query(day, *aggregates).filter(*new_rows).group_by(day).all():
+        _add_delta(deltas, row[0], OVERALL_SEGMENT, **dict(zip(names, row[1:])))
+
+    for field in SEGMENTATION_FIELDS:
+        segment_column = segment_column_for(field)
+        rows = query_by_segment(field, day, segment_column, *aggregates).join(
+            model, Customer.cb_id == model.cb_id
+        ).filter(*new_rows).group_by(day, segment_column).all()
+        for row in rows:
+            _add_delta(deltas, row[0], f"{field}: {segment_label(row[1])}", **dict(zip(names, row[2:])))
+
+
+def _grouped_sketches(sketches, model, day, integration_id, low, high, filters=()):
+    """Add the customers of the rows with low < id <= high to per-(day, segment) sketches."""
+    new_rows = [model.custobar_integration_id == integration_id, model.id > low, model.id <= high,
+                model.cb_id.isnot(None), *filters]
+
+    def sketch(row_day, segment):
+        return sketches.setdefault((_as_date(row_day), segment), HyperLogLog())
+
+    for row_day, cb_id in db.session.query(day, model.cb_id).filter(*new_rows).distinct():
+        sketch(row_day, OVERALL_SEGMENT).add(cb_id)
+
+    for field in SEGMENTATION_FIELDS:
+        segment_column = segment_column_for(field)
+        rows = query_by_segment(field, day, segment_column, model.cb_id).join(
+            model, Customer.cb_id == model.cb_id
+        ).filter(*new_rows).distinct()
+        for row_day, value, cb_id in rows:
+            sketch(row_day, f"{field}: {segment_label(value)}").add(cb_id)
+
+
+def _apply_deltas(integration_id, deltas, sketch_column, sketches):
+    """Add the deltas onto existing rollup rows and insert rows for new (day, segment) keys.
+
+    New sketches are merged into the row's existing `sketch_column` sketch.
+    """
+    sketches = sketches or {}
+    keys = set(deltas) | set(sketches)
+    existing = {}
+    days = sorted({day for day, _ in keys})
+    for start in range(0, len(days), ROLLUP_DAY_BATCH_SIZE):
+        rows = db.session.query(DailyRollup).filter(
+            DailyRollup.custobar_integration_id == integration_id,
+            DailyRollup.day.in_(days[start:start + ROLLUP_DAY_BATCH_SIZE])
+        ).all()
+        existing.update({(row.day, row.segment): row for row in rows})
+
+    updates = []
+    inserts = []
+    for day, segment in keys:
+        delta = deltas.get((day, segment)) or dict.fromkeys(ROLLUP_COUNTERS, 0)
+        row = existing.get((day, segment))
+        if row:
+            values = dict({key: getattr(row, key) + delta[key] for key in ROLLUP_COUNTERS}, id=row.id)
+        else:
+            values = dict(delta, custobar_integration_id=integration_id, day=day, segment=segment)
+
+        # Every mapping carries the sketch column, so each bulk call stays one executemany batch
+        stored_sketch = getattr(row, sketch_column) if row else None
+        sketch = sketches.get((day, segment))
+        if sketch:
+            if stored_sketch:
+                sketch.merge_bytes(stored_sketch)
+            stored_sketch = sketch.to_bytes()
+        values[sketch_column] = stored_sketch
+
+        (updates if row else inserts).append(values)
+
+    if updates:
+        db.session.bulk_update_mappings(DailyRollup, updates)
+    if inserts:
+        db.session.bulk_insert_mappings(DailyRollup, inserts, render_nulls=True)
+
+
+def update_rollups(integration_id):
+    """Fold transactions and events added since the last run into the daily rollups.
+
+    New rows are found by id above each source's watermark, so the cost is
+    proportional to the new data. Rows are attributed to the segments their
+    customer is in at rollup time. Purchasing and visiting customers are added
+    to each row's HyperLogLog sketches. Returns the number of rows rolled up.
+    """
+    sources = [
+        ('transactions', Transaction, func.date(Transaction.transaction_date),
+         [func.sum(Transaction.revenue), func.count(Transaction.id)], ['revenue', 'transactions'], (),
+         'active_customers_sketch', ()),
+        ('events', Event, func.date(Event.date),
+         [func.sum(case((Event.event_type == event_type, 1), else_=0))
+          for event_type in ('visit', 'BROWSE', 'MAIL_OPEN', 'MAIL_CLICK')],
+         ['visits', 'browse_events', 'mail_opens', 'mail_clicks'],
+         (Event.event_type.in_(['visit', 'BROWSE', 'MAIL_OPEN', 'MAIL_CLICK']),),
+         'visitors_sketch', (Event.event_type.in_(['visit', 'BROWSE']),)),
+    ]
+
+    rolled_up = 0
+    for source, model, day, aggregates, names, filters, sketch_column, sketch_filters in sources:
+        watermark, last_id, max_id = _new_id_range(model, integration_id, source)
+        if max_id is None:
+            continue
+
+        deltas = {}
+        _grouped_deltas(deltas, model, day, integration_id, last_id, max_id, aggregates, names, filters)
+        sketches = {}
+        _grouped_sketches(sketches, model, day, integration_id, last_id, max_id, sketch_filters)
+        _apply_deltas(integration_id, deltas, sketch_column, sketches)
+
+        rolled_up += db.session.query(func.count(model.id)).filter(
+            model.custobar_integration_id == integration_id, model.id > last_id, model.id <= max_id
+        ).scalar()
+
+        if not watermark:
+            watermark = RollupWatermark(custobar_integration_id=integration_id, source=source)
+            db.session.add(watermark)
+        watermark.last_id = max_id
+
+        # Commit each source with its watermark so a failure never double counts
+        db.session.commit()
+        logger.info("Rolled up %s", source, extra={"integration_id": integration_id, "first_id": last_id + 1,
+                                                   "last_id": max_id, "daily_rows": len(deltas)})
+
+    return rolled_up
+
+
+def estimate_distinct_customers(integration_id, start, end, segments=(OVERALL_SEGMENT,)):
+    """Estimate distinct purchasing and visiting customers between two days (inclusive).
+
+    The per-day sketches of every requested segment are merged, so any window
+    and any union of segments (e.g. several cities) costs O(days x segments)
+    sketch merges instead of a COUNT(DISTINCT) over the raw rows.
+    """
+    active = HyperLogLog()
+    visitors = HyperLogLog()
+    rows = db.session.query(DailyRollup.active_customers_sketch, DailyRollup.visitors_sketch).filter(
+        DailyRollup.custobar_integration_id == integration_id,
+        DailyRollup.segment.in_(segments),
+        DailyRollup.day >= start,
+        DailyRollup.day <= end
+    )
+    for active_sketch, visitors_sketch in rows:
+        if active_sketch:
+            active.merge_bytes(active_sketch)
+        if visitors_sketch:
+            visitors.merge_bytes(visitors_sketch)
+
+    return {"active_customers": active.count(), "unique_visitors": visitors.count()}
+
+
+def _rollup_sums(integration_id, cutoff):
+    """Sum the rollups per segment, all-time and within the lookback window."""
+    recent = DailyRollup.day >= cutoff
+    rows = db.session.query(
+        DailyRollup.segment,
+        func.sum(DailyRollup.revenue),
+        func.sum(case((recent, DailyRollup.revenue), else_=0)),
+        func.sum(DailyRollup.transactions),
+        func.sum(case((recent, DailyRollup.transactions), else_=0)),
+        func.sum(DailyRollup.visits),
+        func.sum(case((recent, DailyRollup.browse_events), else_=0)),
+        func.sum(case((recent, DailyRollup.mail_opens), else_=0)),
+        func.sum(case((recent, DailyRollup.mail_clicks), else_=0))
+    ).filter(
+        DailyRollup.custobar_integration_id == integration_id
+    ).group_by(DailyRollup.segment).all()
+
+    names = ['revenue_all', 'revenue_window', 'transactions_all', 'transactions_window', 'visits',
+             'browse_window', 'opens_window', 'clicks_window']
+    return {row[0]: {name: value or 0 for name, value in zip(names, row[1:])} for row in rows}
+
+
+def calculate_metrics_from_rollups(integration_id, lookback=3000):
+    """Compute today's Metrics and SegmentedMetrics from the daily rollups.
+
+    Transaction and event figures are sums over rollup days; customer counts
+    come from one grouped pass over customers, with active customers taken from
+    last_purchase_date (kept current by update_last_action_and_purchase_dates).
+    Returns the number of segment rows written.
+    """
+    today = datetime.utcnow().date()
+    cutoff = today - timedelta(days=lookback)
+    sums = _rollup_sums(integration_id, cutoff)
+
+    customer_counts = [
+        func.count(Customer.id),
+        func.sum(case((Customer.signup_date >= cutoff, 1), else_=0)),
+        func.sum(case((Customer.last_purchase_date >= cutoff, 1), else_=0)),
+        func.sum(case((Customer.last_purchase_date.isnot(None), 1), else_=0)),
+    ]
+
+    # Integration-wide metrics
+    total_customers, new_customers, active_customers, _ = db.session.query(*customer_counts).filter(
+        Customer.custobar_integration_id == integration_id
+    ).one()
+    overall = sums.get(OVERALL_SEGMENT, {})
+    write_metrics(integration_id, today, metrics_row({
+        "total_customers": total_customers or 0,
+        "new_customers": new_customers or 0,
+        "active_customers": active_customers or 0,
+        "total_revenue": overall.get("revenue_all", 0),
+        "window_revenue": overall.get("revenue_window", 0),
+        "all_transactions": overall.get("transactions_all", 0),
+        "num_transactions": overall.get("transactions_window", 0),
+        "visitors": overall.get("visits", 0),
+        "mail_open_count": overall.get("opens_window", 0),
+        "mail_click_count": overall.get("clicks_window", 0),
+    }))
+
+    # Segmented metrics, one grouped customer query per field plus the rollup sums
+    segments_written = 0
+    for field in SEGMENTATION_FIELDS:
+        segment_column = segment_column_for(field)
+        segments = {}
+        rows = query_by_segment(field, segment_column, *customer_counts).filter(
+            Customer.custobar_integration_id == integration_id
+        ).group_by(segment_column).all()
+        for value, total, new, active, purchasers in rows:
+            merge_segment_values(segments, value, {
+                "total_customers": total,
+                "new_customers": new,
+                "active_customers": active,
+                "total_customers_for_clv": purchasers,
+            })
+
+        prefix = f"{field}: "
+        for segment, values in sums.items():
+            if segment.startswith(prefix):
+                merge_segment_values(segments, segment[len(prefix):], {
+                    "total_revenue": values["revenue_window"],
+                    "num_transactions": values["transactions_window"],
+                    "total_revenue_for_clv": values["revenue_all"],
+                    "visitors": values["browse_window"],
+                    "mail_open_count": values["opens_window"],
+                    "mail_click_count": values["clicks_window"],
+                })
+
+        segment_rows = [segment_metrics_row(field, label, segment) for label, segment in segments.items()]
+        write_segmented_metrics(integration_id, today, segment_rows)
+        segments_written += len(segment_rows)
+
+    db.session.commit()
+    return segments_written
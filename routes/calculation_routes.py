@@ -1,33 +1,183 @@
-from flask import Blueprint, jsonify
-from flask_jwt_extended import jwt_required
-from process_data import calculate_metrics, update_last_action_and_purchase_dates, calculate_segmented_metrics  # Assuming this function is defined elsewhere
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from flask import Blueprint, current_app, jsonify, request
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from models import CustobarIntegration, Metrics, SegmentedMetrics, db
+from process_data import run_populate_metrics
+from rollups import OVERALL_SEGMENT, estimate_distinct_customers
+from jobs import enqueue_job, JobConflict
+import metrics_cache
+import json
 
 
 calculation_bp = Blueprint('calculation_bp', __name__)
 
+# Columns that can be requested from the metrics endpoint, per table
+METRIC_FIELDS = [
+    'active_customers', 'new_customers', 'passive_customers', 'total_revenue',
+    'avg_purchase_revenue_per_customer', 'avg_purchase_revenue_per_active_customer', 'avg_purchase_size',
+    'visitors_website_from_customers', 'customer_lifetime_value_overall',
+    'customer_lifetime_value_active_customers', 'open_rate', 'click_rate', 'conversion_rate', 'opt_outs',
+    'opens', 'clicks', 'transactions',
+]
+
+METRIC_INTERVALS = ['day', 'week', 'month']
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+
 
 @calculation_bp.route('/<int:integration_id>/populate_metrics', methods=['POST'])
 @jwt_required()
 def populate_metrics(integration_id):
-    """Populate the metrics table for a specific integration."""
+    """Start populating the metrics tables for a specific integration."""
     try:
-        # Calculate the metrics using the integration_id
-        print("Calculating metrics")
+        # Metrics, segmented metrics and last action dates are computed on the job pool
+        # {"incremental": true} answers from the daily rollups instead of rescanning history
+        options = request.get_json(silent=True) or {}
+        incremental = bool(options.get('incremental', False))
+
+        job = enqueue_job('populate_metrics', integration_id, run_populate_metrics, integration_id,
+                          incremental)
 
-        result = calculate_metrics(integration_id)
+        return jsonify({"message": "Metrics calculation started", "job_id": job.id}), 202
 
-        print("Done calculating metrics")
+    except JobConflict as e:
+        return jsonify({"message": "Metrics calculation already in progress", "job_id": e.job.id}), 409
 
-        result = calculate_segmented_metrics(integration_id)
+    except Exception as e:
+        return jsonify({"message": "Error populating metrics", "error": str(e)}), 500
 
-        print("Done calculating segmented metrics")
 
-        # After calculating and saving metrics
-        update_last_action_and_purchase_dates()  # Call the function to update the dates
+@calculation_bp.route('/<int:integration_id>/metrics', methods=['GET'])
+@jwt_required()
+def get_metrics(integration_id):
+    """Return stored metrics for a date range.
 
-        print("Done calculating last action data")
+    Query parameters: start and end (YYYY-MM-DD, inclusive), interval (day,
+    week or month), fields (comma separated), segment (read SegmentedMetrics
+    for e.g. "city: Helsinki"), page and per_page.
+    """
+    identity = json.loads(get_jwt_identity())
+    integration = CustobarIntegration.query.filter_by(id=integration_id, user_id=identity.get("user_id")).first()
+    if not integration:
+        return jsonify({"message": "Unauthorized or invalid integration"}), 403
 
-        return jsonify({"message": "Metrics populated successfully"}), 200
+    try:
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else datetime.utcnow().date()
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else end - timedelta(days=365)
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(MAX_PAGE_SIZE, max(1, int(request.args.get('per_page', DEFAULT_PAGE_SIZE))))
+    except ValueError as e:
+        return jsonify({"message": "Invalid query parameter", "error": str(e)}), 400
 
-    except Exception as e:
-        return jsonify({"message": "Error populating metrics", "error": str(e)}), 500
\ No newline at end of file
+    interval = request.args.get('interval', 'day')
+    if interval not in METRIC_INTERVALS:
+        return jsonify({"message": f"interval must be one of {', '.join(METRIC_INTERVALS)}"}), 400
+
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else METRIC_FIELDS
+    unknown = [field for field in fields if field not in METRIC_FIELDS]
+    if unknown:
+        return jsonify({"message": f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    segment = request.args.get('segment')
+
+    # Served from the response cache until any process writes new metric rows for the integration
+    key = metrics_cache.cache_key(integration, start=start, end=end, interval=interval, fields=fields,
+                                  segment=segment, page=page, per_page=per_page)
+    cached = metrics_cache.get(key)
+    if cached:
+        etag, result = cached
+    else:
+        etag, result = metrics_cache.store(key, read_metrics_series(integration_id, start, end, interval, fields,
+                                                                    segment, page, per_page))
+
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(result)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@calculation_bp.route('/<int:integration_id>/distinct_customers', methods=['GET'])
+@jwt_required()
+def get_distinct_customers(integration_id):
+    """Estimate distinct purchasing and visiting customers for any window and union of segments.
+
+    Query parameters: start and end (YYYY-MM-DD, inclusive) and segment,
+    repeatable (e.g. segment=city: Helsinki&segment=city: Espoo); without a
+    segment the whole integration is counted. Answered from the daily rollup
+    sketches, so run update_rollups first.
+    """
+    identity = json.loads(get_jwt_identity())
+    integration = CustobarIntegration.query.filter_by(id=integration_id, user_id=identity.get("user_id")).first()
+    if not integration:
+        return jsonify({"message": "Unauthorized or invalid integration"}), 403
+
+    try:
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else datetime.utcnow().date()
+        start = date.fromisoformat(request.args['start']) if request.args.get('start') else end - timedelta(days=365)
+    except ValueError as e:
+        return jsonify({"message": "Invalid query parameter", "error": str(e)}), 400
+
+    segments = request.args.getlist('segment') or [OVERALL_SEGMENT]
+    counts = estimate_distinct_customers(integration_id, start, end, segments)
+    return jsonify(dict(counts, start=start.isoformat(), end=end.isoformat(), segments=segments)), 200
+
+
+def _bucket(day, interval):
+    """Return the first day of the interval that `day` falls into."""
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+    if interval == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _json_value(value):
+    return float(value) if isinstance(value, Decimal) else value
+
+
+def read_metrics_series(integration_id, start, end, interval, fields, segment=None, page=1, per_page=DEFAULT_PAGE_SIZE):
+    """Read a metric time series from the precomputed Metrics/SegmentedMetrics rows.
+
+    Only the requested columns are selected. Metrics are daily snapshots, so a
+    week or month is represented by its latest row.
+    """
+    model = SegmentedMetrics if segment else Metrics
+    query = db.session.query(model.date, *[getattr(model, field) for field in fields]).filter(
+        model.custobar_integration_id == integration_id,
+        model.date >= start,
+        model.date < end + timedelta(days=1)
+    )
+    if segment:
+        query = query.filter(SegmentedMetrics.segment == segment)
+
+    # Rows are ordered by date, so the last row seen for a bucket is its latest
+    buckets = {}
+    for row in query.order_by(model.date).all():
+        day = row[0].date() if isinstance(row[0], datetime) else row[0]
+        buckets[_bucket(day, interval)] = row[1:]
+
+    series = [
+        dict({"date": bucket.isoformat()}, **{field: _json_value(value) for field, value in zip(fields, values)})
+        for bucket, values in buckets.items()
+    ]
+    offset = (page - 1) * per_page
+
+    return {
+        "integration_id": integration_id,
+        "segment": segment,
+        "interval": interval,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "page": page,
+        "per_page": per_page,
+        "total": len(series),
+        "next_page": page + 1 if offset + per_page < len(series) else None,
+        "metrics": series[offset:offset + per_page],
+    }
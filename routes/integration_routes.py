@@ -1,11 +1,23 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app
+from concurrent.futures import ThreadPoolExecutor
 import json
-from models import CustobarIntegration, User, Customer, Transaction, db, Event
-import requests
+from models import (CustobarIntegration, User, Customer, Transaction, db, Event, SyncCursor, CustomerTag,
+                    CustomerMailingList)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from custobar_client import CustobarClient
+from jobs import enqueue_job, JobConflict
+from rollups import lock_against_rollups
+from instrumentation import stage, track
+from structured_logging import log_sampled
+import logging
+import hashlib
+import os
 import time
 from datetime import datetime
 
 integration_bp = Blueprint('integration_bp', __name__)
+logger = logging.getLogger(__name__)
 
 # Add Custobar integration
 from flask_jwt_extended import jwt_required, get_jwt_identity
@@ -45,7 +57,7 @@ def get_integrations(user_id):
         identity_json = get_jwt_identity()  # This is the serialized JSON string
         identity = json.loads(identity_json)  # Deserialize the JSON string
         token_user_id = identity.get("user_id")
-        print("JWT Identity:", identity)  # Debugging
+        logger.debug("JWT identity: %s", identity)
 
         # Validate the user_id matches the token user_id
         if token_user_id != user_id:
@@ -66,11 +78,12 @@ def get_integrations(user_id):
 
         return jsonify({"integrations": integrations_list}), 200
     except Exception as e:
-        print("Error in get_integrations:", str(e))
+        logger.exception("Error in get_integrations")
         return jsonify({"message": "Internal server error"}), 500
 
 
-CUSTOBAR_BASE_URL = "https://hopkins.custobar.com/api"  # Replace with actual domain
+# Custobar API root; point it at mock_custobar.py to load-test the sync offline
+CUSTOBAR_BASE_URL = os.environ.get("CUSTOBAR_BASE_URL", "https://hopkins.custobar.com/api").rstrip('/')
 
 @integration_bp.route('/<int:integration_id>/fetch_data', methods=['POST', 'OPTIONS'])
 def handle_fetch_data(integration_id):
@@ -84,20 +97,20 @@ def fetch_custobar_data(integration_id):
     # Validate integration ownership
     # Fetch the identity and deserialize if it's a JSON string
     identity_raw = get_jwt_identity()
-    print("Raw JWT Identity:", identity_raw)
+    logger.debug("Raw JWT identity: %s", identity_raw)
 
     if isinstance(identity_raw, str):
         try:
             identity = json.loads(identity_raw)
         except json.JSONDecodeError as e:
-            print(f"Failed to parse JWT Identity: {e}")
+            logger.warning("Failed to parse JWT identity: %s", e)
             return jsonify({"message": "Invalid token format"}), 401
     elif isinstance(identity_raw, dict):
         identity = identity_raw
     else:
         return jsonify({"message": "Unexpected token format"}), 401
 
-    print("Final JWT Identity:", identity)
+    logger.debug("Final JWT identity: %s", identity)
     user_id = identity['user_id']
 
     # Validate integration ownership
@@ -106,254 +119,527 @@ def fetch_custobar_data(integration_id):
     if not integration:
         return jsonify({"message": "Unauthorized or invalid integration"}), 403
 
+    # Prepare API request
+    query_params = request.json or {}  # Accept query params (e.g., {"email": "test@example.com"})
+    query_params['limit'] = query_params.get('limit', 10000)  # Default limit
+    full_sync = bool(query_params.pop('full_sync', False))  # Ignore stored cursors and re-fetch everything
     try:
-        # Prepare API request
-        api_key = integration.api_key
-        headers = {"Authorization": f"Bearer {api_key}"}
-        query_params = request.json or {}  # Accept query params (e.g., {"email": "test@example.com"})
-        query_params['limit'] = query_params.get('limit', 10000)  # Default limit
+        batch_size = int(query_params.pop('batch_size', SAVE_BATCH_SIZE))  # Records saved per commit
+    except (TypeError, ValueError):
+        batch_size = 0
+    if batch_size < 1:
+        return jsonify({"message": "batch_size must be a positive integer"}), 400
 
+    # Run the sync on the job pool and let the client poll /job/<id> for progress
+    try:
+        job = enqueue_job('fetch_data', integration.id, run_fetch_data, integration.id, integration.api_key,
+                          query_params, full_sync, batch_size)
+    except JobConflict as e:
+        return jsonify({"message": "Data fetch already in progress", "job_id": e.job.id}), 409
+
+    return jsonify({"message": "Data fetch started", "job_id": job.id}), 202
+
+
+def run_fetch_data(integration_id, api_key, query_params, full_sync=False, batch_size=None, progress=None):
+    """Fetch and save events, customers and transactions for an integration.
+
+    Each resource is synced from its stored cursor, sharing one pooled,
+    rate-limited client. Customers are synced first, since sales and events
+    reference them by cb_id (a foreign key on PostgreSQL); sales and events
+    then run concurrently. Requires an app context.
+    """
+    if progress:
+        progress.phase('fetch')
+
+    app = current_app._get_current_object()
+    stages = [
+        [('customers', fetch_customer_data, save_customers)],
+        [('events', fetch_event_data, save_events), ('sales', fetch_transaction_data, save_transactions)],
+    ]
+    with CustobarClient(api_key) as client, ThreadPoolExecutor(max_workers=2) as executor:
+        for streams in stages:
+            futures = [
+                executor.submit(sync_resource_in_app_context, app, integration_id, resource, fetch, save,
+                                client, query_params, full_sync, batch_size, progress)
+                for resource, fetch, save in streams
+            ]
+            for future in futures:
+                future.result()  # Re-raise the first failure, before any dependent resource starts
+
+    logger.info("Data fetched", extra={"integration_id": integration_id})
+
+
+# Record field used as the high-water mark for each resource, and the Custobar
+# query parameter that filters a resource to records at or after that mark
+SYNC_CURSOR_FIELDS = {
+    'customers': 'last_modified',
+    'sales': 'date',
+    'events': 'date',
+}
+SYNC_CURSOR_PARAMS = {
+    'customers': 'last_modified__gte',
+    'sales': 'date__gte',
+    'events': 'date__gte',
+}
+
+# Records saved per commit; the session is emptied after each chunk so memory stays flat
+SAVE_BATCH_SIZE = int(os.environ.get("SAVE_BATCH_SIZE", 2000))
+
+
+def record_timestamp(record, resource):
+    """Return the record's high-water-mark timestamp as a naive datetime, or None."""
+    value = record.get(SYNC_CURSOR_FIELDS[resource])
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+def sync_resource_in_app_context(app, integration_id, resource, *args):
+    """Run sync_resource on a worker thread with its own app context, session and query statistics."""
+    with app.app_context(), track('sync', resource):
+        logger.debug("Fetching %s", resource, extra={"integration_id": integration_id})
+        sync_resource(integration_id, resource, *args)
+
+
+def sync_resource(integration_id, resource, fetch, save, client, query_params, full_sync=False, batch_size=None,
+                  progress=None):
+    """Fetch one resource from its stored cursor onwards and save it in chunks.
+
+    Records older than the cursor are dropped before reaching `save`, in case
+    the API ignores the filter parameter. Each chunk of `batch_size` records is
+    committed and expunged on its own, and after every page the next page URL
+    is checkpointed, so an interrupted sync resumes where it stopped instead of
+    starting over (full_sync discards the checkpoint). The cursor itself only
+    advances once every page has been saved.
+    """
+    batch_size = batch_size or SAVE_BATCH_SIZE
+    cursor = SyncCursor.query.filter_by(custobar_integration_id=integration_id, resource=resource).first()
+    last_seen = cursor.last_seen if cursor and not full_sync else None
+    resume_url = cursor.resume_url if cursor and not full_sync else None
+
+    params = dict(query_params)
+    if last_seen:
+        params[SYNC_CURSOR_PARAMS[resource]] = last_seen.isoformat()
+        logger.info("Fetching %s changed since %s", resource, last_seen.isoformat(),
+                    extra={"integration_id": integration_id})
+
+    high_water_mark = last_seen
+    if resume_url:
+        logger.info("Resuming %s from %s", resource, resume_url, extra={"integration_id": integration_id})
+        if cursor.checkpoint and (high_water_mark is None or cursor.checkpoint > high_water_mark):
+            high_water_mark = cursor.checkpoint
+
+    started = time.perf_counter()
+    saved = 0
+    for page, next_url in fetch(client, params, resume_url):
+        records = []
+        with stage('parse', len(page)):
+            for record in page:
+                timestamp = record_timestamp(record, resource)
+                if last_seen and timestamp and timestamp < last_seen:
+                    continue
+                if timestamp and (high_water_mark is None or timestamp > high_water_mark):
+                    high_water_mark = timestamp
+                records.append(record)
+
+        for chunk in chunked(records, batch_size):
+            with stage('save', len(chunk)):
+                save(chunk, integration_id)  # Commits the chunk
+            db.session.expunge_all()
+            saved += len(chunk)
+            if progress:
+                progress.add(len(chunk))
+
+        if next_url:
+            update_sync_cursor(integration_id, resource, resume_url=next_url, checkpoint=high_water_mark)
+
+        elapsed = time.perf_counter() - started
+        log_sampled(logger, logging.INFO, f"saved:{integration_id}:{resource}",
+                    "Saved %s %s so far (%.0f rows/s)", saved, resource, saved / elapsed if elapsed else 0,
+                    integration_id=integration_id)
+
+    elapsed = time.perf_counter() - started
+    logger.info("Synced %s", resource, extra={
+        "integration_id": integration_id,
+        "rows": saved,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(saved / elapsed, 1) if elapsed else 0,
+    })
+
+    # Every page is saved: advance the cursor and drop the checkpoint
+    fields = {"resume_url": None, "checkpoint": None}
+    if high_water_mark:
+        fields["last_seen"] = high_water_mark
+    update_sync_cursor(integration_id, resource, **fields)
+
+
+def update_sync_cursor(integration_id, resource, **fields):
+    """Write fields of an integration's sync cursor, creating the cursor if needed, and commit."""
+    cursor = SyncCursor.query.filter_by(custobar_integration_id=integration_id, resource=resource).first()
+    if not cursor:
+        cursor = SyncCursor(custobar_integration_id=integration_id, resource=resource)
+        db.session.add(cursor)
+    for name, value in fields.items():
+        setattr(cursor, name, value)
+    cursor.updated_at = datetime.utcnow()
+    db.session.commit()
 
-        # Fetch and save events
-        print("Fetching events...")
-        events = fetch_event_data(headers, query_params)
-        save_events(events, integration.id)
-
-        # Fetch and save customers
-        print("Fetching customers...")
-        customers = fetch_customer_data(headers, query_params)
-        save_customers(customers, integration.id)
-
-        # Fetch and save transactions
-        print("Fetching transactions...")
-        transactions = fetch_transaction_data(headers, query_params)
-        save_transactions(transactions, integration.id)
-
-        return jsonify({"message": "Data fetched successfully"}), 200
-
-    except Exception as e:
-        print(f"Error fetching data: {e}")
-        return jsonify({"message": "Error fetching data", "error": str(e)}), 500
 
+def fetch_pages(url, client, query_params, resource):
+    """Yield (records, next_url) for one page of `resource` at a time, following `next_url`.
 
-# Fetch customer data
-def fetch_customer_data(headers, query_params):
-    url = f"{CUSTOBAR_BASE_URL}/data/customers/"
-    customers = []
+    Only the current page is held in memory, so callers can save each page
+    before the next one is requested. Pacing and retries are handled by `client`.
+    """
     counter = 0
     while url:
-        response = requests.get(url, headers=headers, params=query_params if '?' not in url else None)
-        print("Fetching URL:", url)
+        with stage('fetch'):
+            response = client.get(url, params=query_params if '?' not in url else None)
+        logger.debug("Fetched %s", url)
 
         if response.status_code != 200:
-            print(f"Failed to fetch customers: {response.text}")
-            raise Exception("Error fetching customer data")
+            logger.error("Failed to fetch %s: %s %s", resource, response.status_code, response.text[:500])
+            raise Exception(f"Error fetching {resource} data")
 
         try:
-            data = response.json()
-            print(f"Received {len(data.get('customers', []))} customers")
-            counter = counter + len(data.get('customers', []))
-            print(f"Total count {counter} / {data.get('count', [])} customers")
+            with stage('parse'):
+                data = response.json()
         except ValueError as e:
-            print(f"JSON Decode Error: {e}")
+            logger.error("Could not decode %s page %s: %s", resource, url, e)
             raise Exception("Error decoding Custobar response")
 
-        customers.extend(data.get('customers', []))
+        records = data.get(resource, [])
+        counter = counter + len(records)
+        log_sampled(logger, logging.INFO, f"fetched:{resource}", "Fetched %s / %s %s", counter, data.get('count'),
+                    resource)
+
         url = data.get('next_url')  # Use absolute URL for the next batch
 
-        time.sleep(1)  # Respect API rate limits
+        yield records, url
 
-        break
 
-    return customers
+# Fetch customer data, optionally resuming from a checkpointed page URL
+def fetch_customer_data(client, query_params, resume_url=None):
+    return fetch_pages(resume_url or f"{CUSTOBAR_BASE_URL}/data/customers/", client, query_params, 'customers')
 
 # Fetch transaction data
-def fetch_transaction_data(headers, query_params):
-    url = f"{CUSTOBAR_BASE_URL}/data/sales/"
-    transactions = []
-
-    counter = 0
-    while url:
-        response = requests.get(url, headers=headers, params=query_params if '?' not in url else None)
-        print("Fetching URL:", url)
-
-        if response.status_code != 200:
-            print(f"Failed to fetch transactions: {response.text}")
-            raise Exception("Error fetching transaction data")
-
-        try:
-            data = response.json()
-            print(f"Received {len(data.get('sales', []))} transactions")
-            counter = counter + len(data.get('sales', []))
-            print(f"Total count {counter} / {data.get('count')} transactions")
-        except ValueError as e:
-            print(f"JSON Decode Error: {e}")
-            raise Exception("Error decoding Custobar response")
-
-        transactions.extend(data.get('sales', []))
-        url = data.get('next_url')  # Use absolute URL for the next batch
-
-        time.sleep(1)  # Respect API rate limits
-
-        break
-
-    return transactions
+def fetch_transaction_data(client, query_params, resume_url=None):
+    return fetch_pages(resume_url or f"{CUSTOBAR_BASE_URL}/data/sales/", client, query_params, 'sales')
 
 # Fetch event data
-def fetch_event_data(headers, query_params):
-    url = f"{CUSTOBAR_BASE_URL}/data/events/"
-    events = []
-    counter = 0
-    while url:
-        response = requests.get(url, headers=headers, params=query_params if '?' not in url else None)
-        print("Fetching URL:", url)
+def fetch_event_data(client, query_params, resume_url=None):
+    return fetch_pages(resume_url or f"{CUSTOBAR_BASE_URL}/data/events/", client, query_params, 'events')
 
-        if response.status_code != 200:
-            print(f"Failed to fetch events: {response.text}")
-            raise Exception("Error fetching event data")
+# Maximum number of values bound into a single IN (...) lookup
+LOOKUP_BATCH_SIZE = 500
 
-        try:
-            data = response.json()
-            print(f"Received {len(data.get('events', []))} events")
-            counter = counter +  len(data.get('events', []))
-            print(f"Received {counter} / {data.get('count', [])} events")
 
-        except ValueError as e:
-            print(f"JSON Decode Error: {e}")
-            raise Exception("Error decoding Custobar response")
+def chunked(items, size):
+    """Split a list into consecutive slices of at most `size` items."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
 
-        events.extend(data.get('events', []))
-        url = data.get('next_url')  # Use absolute URL for the next batch
 
-        time.sleep(1)  # Respect API rate limits
+def parse_custobar_datetime(value):
+    """Parse Custobar's customer timestamp format, returning None for empty values."""
+    if not value:
+        return None
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
 
-        break
+# Customer date columns and the Custobar fields they are parsed from
+CUSTOMER_DATE_FIELDS = (("signup_date", 'date_joined'), ("last_purchase_date", 'last_purchase_date'),
+                        ("last_action_date", 'last_action_date'), ("last_login", 'last_login'))
 
-    return events
 
 def save_customers(customers, integration_id):
-    """Save or update customer data in the database."""
+    """Save or update customer data in the database.
+
+    Existing customers for the page are looked up with batched IN queries, then
+    new and changed rows are written with bulk insert/update mappings rather
+    than one SELECT and ORM object per record.
+    """
+    # Build one mapping per cb_id; later records in the page win
+    mappings = {}
     for customer_data in customers:
         cb_id = customer_data.get('external_id')  # Fetch Custobar's external_id
         if not cb_id:
             continue  # Skip if no cb_id (external_id)
 
-        # Check if customer already exists using the cb_id (which is now external_id)
-        customer = Customer.query.filter_by(cb_id=cb_id, custobar_integration_id=integration_id).first()
-        if not customer:
-            # If not found, create a new customer
-            customer = Customer(cb_id=cb_id, custobar_integration_id=integration_id)
-
-        # Update customer data
-        # Convert string dates to datetime objects, if the string is not empty or None
-        if customer_data.get('date_joined'):
-            customer.signup_date = datetime.strptime(customer_data.get('date_joined'), "%Y-%m-%dT%H:%M:%S")
-        if customer_data.get('last_purchase_date'):
-            customer.last_purchase_date = datetime.strptime(customer_data.get('last_purchase_date'),
-                                                            "%Y-%m-%dT%H:%M:%S")
-        if customer_data.get('last_action_date'):
-            customer.last_action_date = datetime.strptime(customer_data.get('last_action_date'), "%Y-%m-%dT%H:%M:%S")
-
-        if customer_data.get('last_login'):
-            customer.last_login = datetime.strptime(customer_data.get('last_login'),
-                                                          "%Y-%m-%dT%H:%M:%S")
-
-        customer.can_email = customer_data.get('can_email')
-        customer.city = customer_data.get('city')
-        customer.country = customer_data.get('country')
-        customer.gender = customer_data.get('gender')
-        customer.language = customer_data.get('language')
-        customer.tags = customer_data.get('tags')
-        customer.mailing_lists = customer_data.get('mailing_lists')
-
-        # Add or update the customer in the session
-        db.session.add(customer)
+        mapping = {
+            "cb_id": cb_id,
+            "custobar_integration_id": integration_id,
+            "can_email": customer_data.get('can_email'),
+            "city": customer_data.get('city'),
+            "country": customer_data.get('country'),
+            "gender": customer_data.get('gender'),
+            "language": customer_data.get('language'),
+            "tags": customer_data.get('tags'),
+            "mailing_lists": customer_data.get('mailing_lists'),
+        }
+
+        # Dates are only overwritten when Custobar sends a value
+        for column, key in CUSTOMER_DATE_FIELDS:
+            if customer_data.get(key):
+                mapping[column] = parse_custobar_datetime(customer_data.get(key))
+
+        mappings[cb_id] = mapping
+
+    if not mappings:
+        return
+
+    # Look up which of these customers already exist
+    existing_ids = {}
+    for cb_ids in chunked(list(mappings), LOOKUP_BATCH_SIZE):
+        existing_ids.update(db.session.query(Customer.cb_id, Customer.id).filter(
+            Customer.custobar_integration_id == integration_id,
+            Customer.cb_id.in_(cb_ids)
+        ).all())
+
+    updates = []
+    inserts = []
+    for cb_id, mapping in mappings.items():
+        if cb_id in existing_ids:
+            updates.append(dict(mapping, id=existing_ids[cb_id]))
+        else:
+            # Every insert carries the same keys, so the page goes out as one executemany batch
+            insert = dict(dict.fromkeys(column for column, _ in CUSTOMER_DATE_FIELDS), **mapping)
+            insert["can_email"] = bool(insert["can_email"])  # Column default for new customers
+            inserts.append(insert)
+
+    if updates:
+        db.session.bulk_update_mappings(Customer, updates)
+    if inserts:
+        # render_nulls keeps None values in the statement instead of dropping their keys per row
+        db.session.bulk_insert_mappings(Customer, inserts, render_nulls=True)
+
+        # Resolve the ids of the customers just inserted for the tag/mailing list links
+        for cb_ids in chunked([mapping["cb_id"] for mapping in inserts], LOOKUP_BATCH_SIZE):
+            existing_ids.update(db.session.query(Customer.cb_id, Customer.id).filter(
+                Customer.custobar_integration_id == integration_id,
+                Customer.cb_id.in_(cb_ids)
+            ).all())
+
+    # Keep the normalized tag and mailing list memberships in step with the JSON columns
+    replace_customer_links(CustomerTag, 'tag', {
+        existing_ids[cb_id]: mapping["tags"] for cb_id, mapping in mappings.items()
+    }, integration_id)
+    replace_customer_links(CustomerMailingList, 'mailing_list', {
+        existing_ids[cb_id]: mapping["mailing_lists"] for cb_id, mapping in mappings.items()
+    }, integration_id)
 
     # Commit the changes to the database
     db.session.commit()
 
 
+def replace_customer_links(model, column, values_by_customer, integration_id):
+    """Replace the link rows (e.g. tags) of the given customers with their current values.
+
+    `values_by_customer` maps customer id to the list from Custobar (or None).
+    Existing links are deleted and the new ones bulk inserted, one row per value.
+    """
+    customer_ids = list(values_by_customer)
+    for batch in chunked(customer_ids, LOOKUP_BATCH_SIZE):
+        db.session.query(model).filter(model.customer_id.in_(batch)).delete(synchronize_session=False)
+
+    links = []
+    for customer_id, values in values_by_customer.items():
+        for value in dict.fromkeys(str(value) for value in values or []):  # Dedupe, keep order
+            links.append({"customer_id": customer_id, "custobar_integration_id": integration_id, column: value})
+
+    if links:
+        db.session.bulk_insert_mappings(model, links)
+
+
 def save_transactions(transactions, integration_id):
-    """Save or update transaction data in the database."""
+    """Save new transaction data in the database.
+
+    The page is deduplicated against itself and against the database with
+    batched lookups on sale_external_id, and the remaining sales are written
+    with a single bulk insert.
+    """
+    mappings = {}
     for transaction in transactions:
         cb_id = transaction.get('customer_id')  # Fetch the customer_id from the sales endpoint
-        if not cb_id:
-            continue  # Skip if no cb_id (customer_id)
-
-        # Check if the transaction already exists by using the sale_external_id
-        existing_transaction = Transaction.query.filter_by(
-            custobar_integration_id=integration_id,
-            cb_id=cb_id,  # Use cb_id to link the transaction to the customer
-            sale_external_id=transaction.get("external_id")
-        ).first()
+        sale_external_id = transaction.get("external_id")
+        if not cb_id or not sale_external_id:
+            continue  # Skip if no cb_id (customer_id) or sale id
 
-        if existing_transaction:
-            continue  # Skip existing transactions
+        if sale_external_id in mappings:
+            continue  # Skip duplicates within the page
 
         # Convert the transaction_date string to a datetime object
         transaction_date_str = transaction.get("date")
-        if transaction_date_str:
-            try:
-                transaction_date = datetime.fromisoformat(transaction_date_str)
-            except ValueError:
-                print(f"Invalid date format for transaction: {transaction_date_str}")
-                transaction_date = None
-        else:
+        try:
+            transaction_date = datetime.fromisoformat(transaction_date_str) if transaction_date_str else None
+        except ValueError:
+            log_sampled(logger, logging.WARNING, "invalid_transaction_date",
+                        "Invalid date format for transaction: %s", transaction_date_str)
             transaction_date = None
 
-        # Create new transaction
-        new_transaction = Transaction(
-            cb_id=cb_id,  # Use cb_id to link to customer
-            sale_external_id=transaction.get("external_id"),
-            custobar_integration_id=integration_id,
-            transaction_date=transaction_date,
-            product_ids=transaction.get("products", []),
-            revenue=transaction.get("total"),
-            action_type=transaction.get("state")  # Assuming you want to store state (complete, cancelled)
-        )
+        if transaction_date is None:
+            continue  # transaction_date is required
+
+        mappings[sale_external_id] = {
+            "cb_id": cb_id,  # Use cb_id to link to customer
+            "sale_external_id": sale_external_id,
+            "custobar_integration_id": integration_id,
+            "transaction_date": transaction_date,
+            "product_ids": transaction.get("products", []),
+            "revenue": transaction.get("total"),
+            "action_type": transaction.get("state")  # Assuming you want to store state (complete, cancelled)
+        }
+
+    # Skip transactions that are already stored for this integration
+    for sale_external_ids in chunked(list(mappings), LOOKUP_BATCH_SIZE):
+        existing = db.session.query(Transaction.sale_external_id).filter(
+            Transaction.custobar_integration_id == integration_id,
+            Transaction.sale_external_id.in_(sale_external_ids)
+        ).all()
+        for (sale_external_id,) in existing:
+            mappings.pop(sale_external_id, None)
 
-        # Add new transaction to the session
-        db.session.add(new_transaction)
+    if mappings:
+        lock_against_rollups(integration_id)
+        db.session.bulk_insert_mappings(Transaction, list(mappings.values()), render_nulls=True)
 
     # Commit the changes to the database
     db.session.commit()
 
+def event_identity(event, cb_id, event_date):
+    """Return a stable key for an event within its integration.
+
+    Custobar's own event id is used when present, otherwise a hash of the fields
+    that make an event unique, so re-fetching the same events yields the same keys.
+    """
+    external_id = event.get("external_id") or event.get("id")
+    if external_id:
+        return f"id:{external_id}"
+    return event_content_key(cb_id, event.get("type"), event_date, event.get("path"))
+
+
+def event_content_key(cb_id, event_type, event_date, path):
+    """Return the content-hash key of an event without a Custobar id."""
+    # The date is hashed as stored (without tzinfo) so keys match ones backfilled from the database
+    content = "|".join([cb_id, event_type or "", event_date.replace(tzinfo=None).isoformat(), path or ""])
+    return "sha256:" + hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def adopt_content_keyed_events(mappings, integration_id):
+    """Move stored events from their content-hash key to the id: key of the incoming event.
+
+    Events stored before they had an id key (e.g. rows backfilled by the
+    event_key migration, as the events table keeps no Custobar id) would
+    otherwise be inserted again under their id: key. Returns the mappings
+    that still need inserting.
+    """
+    content_keys = {mapping["event_key"]: event_content_key(mapping["cb_id"], mapping["event_type"],
+                                                            mapping["date"], mapping["path"])
+                    for mapping in mappings if mapping["event_key"].startswith("id:")}
+    if not content_keys:
+        return mappings
+
+    stored = {}
+    for event_keys in chunked(list(content_keys) + list(content_keys.values()), LOOKUP_BATCH_SIZE):
+        stored.update(db.session.query(Event.event_key, Event.id).filter(
+            Event.custobar_integration_id == integration_id,
+            Event.event_key.in_(event_keys)
+        ).all())
+
+    updates = []
+    remaining = []
+    for mapping in mappings:
+        content_key = content_keys.get(mapping["event_key"])
+        if mapping["event_key"] not in stored and content_key in stored:
+            updates.append({"id": stored.pop(content_key), "event_key": mapping["event_key"]})
+        else:
+            remaining.append(mapping)
+
+    if updates:
+        db.session.bulk_update_mappings(Event, updates)
+    return remaining
+
+
+def insert_ignoring_duplicates(model, mappings, unique_columns):
+    """Bulk insert rows, skipping any that collide on `unique_columns`.
+
+    Uses INSERT ... ON CONFLICT DO NOTHING on SQLite and PostgreSQL; other
+    databases fall back to filtering out existing keys before inserting.
+    """
+    if not mappings:
+        return
+
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert = sqlite_insert if dialect == "sqlite" else postgresql_insert
+        statement = insert(model.__table__).on_conflict_do_nothing(index_elements=unique_columns)
+        db.session.execute(statement, mappings)
+        return
+
+    key_column = unique_columns[-1]
+    keys = list({mapping[key_column]: None for mapping in mappings})
+    existing = set()
+    for batch in chunked(keys, LOOKUP_BATCH_SIZE):
+        query = db.session.query(getattr(model, key_column)).filter(getattr(model, key_column).in_(batch))
+        for column in unique_columns[:-1]:
+            query = query.filter(getattr(model, column) == mappings[0][column])
+        existing.update(key for (key,) in query.all())
+
+    survivors = {}
+    for mapping in mappings:
+        if mapping[key_column] not in existing:
+            survivors.setdefault(mapping[key_column], mapping)
+
+    if survivors:
+        db.session.bulk_insert_mappings(model, list(survivors.values()))
+
+
 def save_events(events, integration_id):
-    """Save or update event data in the database."""
+    """Save new event data in the database.
+
+    Every event gets a stable event_key, and the page is inserted with a single
+    INSERT-or-ignore so re-fetching the same events does not duplicate them.
+    Stored rows keyed by content hash are re-keyed to an incoming event's id.
+    """
+    mappings = []
     for event in events:
         cb_id = event.get('customer_id')  # Fetch the customer_id from the events endpoint
         if not cb_id:
             continue  # Skip if no cb_id (customer_id)
 
-        # Convert the transaction_date string to a datetime object
+        # Convert the event date string to a datetime object
         date_str = event.get("date")
-        if date_str:
-            try:
-                event_date = datetime.fromisoformat(date_str)
-            except ValueError:
-                print(f"Invalid date format for transaction: {date_str}")
-                event_date = None
-        else:
+        try:
+            event_date = datetime.fromisoformat(date_str) if date_str else None
+        except ValueError:
+            log_sampled(logger, logging.WARNING, "invalid_event_date", "Invalid date format for event: %s", date_str)
             event_date = None
 
+        if event_date is None:
+            continue  # date is required and part of the event identity
+
         utm_data = {
             "utm_source": event.get("utm_source", None),
             "utm_medium": event.get("utm_medium", None)
         }
 
-        # Create new event
-        new_event = Event(
-            cb_id=cb_id,  # Use cb_id to link to customer
-            event_type=event.get("type"),  # Event type (e.g. 'BROWSE', 'ORDER_SHIPPED', etc.)
-            date=event_date,  # Event Date
-            utm_data=utm_data,  # Optional additional event-specific data
-            product_id=event.get("product_id"),
-            path=event.get("path"),
-            custobar_integration_id=integration_id
-        )
-
-        # Add new event to the session
-        db.session.add(new_event)
+        mappings.append({
+            "event_key": event_identity(event, cb_id, event_date),
+            "cb_id": cb_id,  # Use cb_id to link to customer
+            "event_type": event.get("type"),  # Event type (e.g. 'BROWSE', 'ORDER_SHIPPED', etc.)
+            "date": event_date,  # Event Date
+            "utm_data": utm_data,  # Optional additional event-specific data
+            "product_id": event.get("product_id"),
+            "path": event.get("path"),
+            "custobar_integration_id": integration_id
+        })
+
+    lock_against_rollups(integration_id)
+    mappings = adopt_content_keyed_events(mappings, integration_id)
+    insert_ignoring_duplicates(Event, mappings, ["custobar_integration_id", "event_key"])
 
     # Commit the changes to the database
-    db.session.commit()
\ No newline at end of file
+    db.session.commit()
@@ -0,0 +1,26 @@
+from flask import Blueprint, jsonify
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from models import CustobarIntegration, Job
+from jobs import job_to_dict
+import json
+
+job_bp = Blueprint('job_bp', __name__)
+
+
+# Get the status and progress of a background job
+@job_bp.route("/<int:job_id>", methods=["GET"])
+@jwt_required()
+def get_job(job_id):
+    identity = json.loads(get_jwt_identity())
+    user_id = identity.get("user_id")
+
+    job = Job.query.get(job_id)
+    if not job:
+        return jsonify({"message": "Job not found"}), 404
+
+    # Only the owner of the job's integration may see it
+    integration = CustobarIntegration.query.filter_by(id=job.custobar_integration_id, user_id=user_id).first()
+    if not integration:
+        return jsonify({"message": "Unauthorized access"}), 403
+
+    return jsonify(job_to_dict(job)), 200
@@ -0,0 +1,10 @@
+from flask import Blueprint, Response
+import instrumentation
+
+metrics_bp = Blueprint('metrics_bp', __name__)
+
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Expose query counts, DB time and per-stage timings in the Prometheus text format."""
+    return Response(instrumentation.registry.render(), mimetype='text/plain; version=0.0.4')
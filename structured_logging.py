@@ -0,0 +1,134 @@
+import json
+import logging
+import logging.handlers
+import multiprocessing.util
+import os
+import queue
+import threading
+import time
+
+# LOG_LEVEL is a standard level name; LOG_FORMAT is "json" (one object per line) or "text"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+
+# Per-item messages (per page, per invalid record) are logged for the first
+# occurrence and then every LOG_SAMPLE_EVERY-th, and at most LOG_SAMPLE_PER_SECOND
+# times a second per message key
+LOG_SAMPLE_EVERY = int(os.environ.get("LOG_SAMPLE_EVERY", 100))
+LOG_SAMPLE_PER_SECOND = float(os.environ.get("LOG_SAMPLE_PER_SECOND", 5))
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+def _extra_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as single-line JSON objects including their `extra` fields."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        entry.update(_extra_fields(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Human-readable format with `extra` fields appended as key=value pairs."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(threadName)s] %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+class Sampler:
+    """Decide which occurrences of a repeated per-item message get logged."""
+
+    def __init__(self, every=LOG_SAMPLE_EVERY, per_second=LOG_SAMPLE_PER_SECOND):
+        self.every = every
+        self.per_second = per_second
+        self._counts = {}
+        self._windows = {}  # key -> (second, messages logged in it)
+        self._lock = threading.Lock()
+
+    def should_log(self, key):
+        """Return the occurrence count if this occurrence should be logged, else None."""
+        with self._lock:
+            count = self._counts.get(key, 0) + 1
+            self._counts[key] = count
+            if count != 1 and count % self.every:
+                return None
+
+            second = int(time.monotonic())
+            window_second, logged = self._windows.get(key, (second, 0))
+            if window_second != second:
+                logged = 0
+            if logged >= self.per_second:
+                return None
+            self._windows[key] = (second, logged + 1)
+            return count
+
+
+_sampler = Sampler()
+
+
+def log_sampled(logger, level, key, message, *args, **extra):
+    """Log a per-item message, sampled per `key`; the record carries the occurrence count."""
+    if not logger.isEnabledFor(level):
+        return
+    count = _sampler.should_log(key)
+    if count is not None:
+        logger.log(level, message, *args, extra=dict(extra, occurrence=count))
+
+
+_listener = None
+_listener_pid = None
+_queue_handler = None
+
+
+def configure_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    """Route all logging through a queue so callers never block on log I/O.
+
+    A QueueListener thread drains the queue into a stderr handler. Calling this
+    again (e.g. for a second app in the same process) does nothing. A forked
+    child (e.g. a ProcessPool worker) inherits the queue handler but not the
+    listener thread, so there it replaces both with its own, which is drained
+    before the child exits.
+    """
+    global _listener, _listener_pid, _queue_handler
+    if _listener and _listener_pid == os.getpid():
+        return
+
+    root = logging.getLogger()
+    if _queue_handler:
+        root.removeHandler(_queue_handler)
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else TextFormatter())
+
+    log_queue = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    _listener_pid = os.getpid()
+    # Runs at interpreter exit and also when a multiprocessing child exits,
+    # which leaves through os._exit and so skips atexit handlers
+    multiprocessing.util.Finalize(None, _listener.stop, exitpriority=0)
+
+    _queue_handler = logging.handlers.QueueHandler(log_queue)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
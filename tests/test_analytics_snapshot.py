@@ -0,0 +1,79 @@
+import os
+import sys
+from datetime import date, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import analytics_snapshot
+from analytics_snapshot import IntegrationSnapshot
+from app import create_app
+from benchmark import SyntheticTenant
+from models import db, CustobarIntegration, User
+from process_data import _segment_aggregates, metrics_queries
+from routes.integration_routes import save_customers, save_events, save_transactions
+
+TENANT = SyntheticTenant(customers=300, transactions=2000, events=2000, cities=8, tags=6, mailing_lists=3,
+                         days=400)
+TODAY = date(2026, 1, 1)
+LOOKBACK = 90
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'snapshot.db'}", "TESTING": True})
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(id=1, email="snapshot@example.com", password="x"))
+        db.session.add(CustobarIntegration(id=1, api_key="key", user_id=1))
+        db.session.commit()
+        for batch in TENANT.customer_batches(500):
+            save_customers(batch, 1)
+        for batch in TENANT.transaction_batches(500):
+            save_transactions(batch, 1)
+        for batch in TENANT.event_batches(500):
+            save_events(batch, 1)
+        yield app
+
+
+def _sql_metrics(cutoff):
+    queries = metrics_queries(1, cutoff)
+    total_customers, new_customers = queries["customers"].one()
+    total_revenue, all_transactions, window_revenue, num_transactions, active_customers = \
+        queries["transactions"].one()
+    visitors, mail_open_count, mail_click_count = queries["events"].one()
+    return {
+        "total_customers": total_customers,
+        "new_customers": new_customers,
+        "active_customers": active_customers,
+        "total_revenue": pytest.approx(float(total_revenue)),
+        "window_revenue": pytest.approx(float(window_revenue)),
+        "all_transactions": all_transactions,
+        "num_transactions": num_transactions,
+        "visitors": visitors,
+        "mail_open_count": mail_open_count,
+        "mail_click_count": mail_click_count,
+    }
+
+
+def _approx_revenue(segments):
+    return {label: {key: pytest.approx(float(value or 0)) if key.startswith("total_revenue") else value or 0
+                    for key, value in segment.items()}
+            for label, segment in segments.items()}
+
+
+@pytest.mark.parametrize("chunk_size", [10000, 128])
+def test_snapshot_metrics_match_sql(app, monkeypatch, chunk_size):
+    monkeypatch.setattr(analytics_snapshot, 'SNAPSHOT_CHUNK_SIZE', chunk_size)
+    snapshot = IntegrationSnapshot.load(1)
+
+    assert snapshot.metrics(LOOKBACK, TODAY) == _sql_metrics(TODAY - timedelta(days=LOOKBACK))
+
+
+@pytest.mark.parametrize("field", ['city', 'tags', 'mailing_lists'])
+def test_snapshot_segmented_metrics_match_sql(app, field):
+    snapshot = IntegrationSnapshot.load(1)
+    segments = snapshot.segmented_metrics([field], LOOKBACK, TODAY)[field]
+
+    assert segments == _approx_revenue(_segment_aggregates(1, field, TODAY - timedelta(days=LOOKBACK)))
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module
+import process_data
+from app import create_app
+from batch_metrics import compute_metrics_batch
+from models import db, CustobarIntegration, User
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    uri = f"sqlite:///{tmp_path / 'batch.db'}"
+    # Worker processes build their own app from the default URL
+    monkeypatch.setattr(app_module, 'DATABASE_URL', uri)
+    app = create_app({"SQLALCHEMY_DATABASE_URI": uri, "TESTING": True})
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(id=1, email="batch@example.com", password="x"))
+        db.session.add(CustobarIntegration(id=1, api_key="key", user_id=1))
+        db.session.commit()
+        yield app
+
+
+def _fail(*args, **kwargs):
+    raise RuntimeError("boom")
+
+
+def test_failed_metrics_and_last_dates_tasks_are_reported(app, monkeypatch):
+    # Worker processes are forked, so they inherit the patched functions
+    monkeypatch.setattr(process_data, 'metrics_queries', _fail)
+    monkeypatch.setattr(process_data, 'last_dates_statements', _fail)
+
+    failures = compute_metrics_batch([1], workers=2, fields=['city'])
+
+    assert sorted(task for _, task, _ in failures) == ['last_dates', 'metrics']
+    assert all(error == "boom" for _, _, error in failures)
+
+
+def test_successful_batch_reports_no_failures(app):
+    assert compute_metrics_batch([1], workers=2, fields=['city']) == []
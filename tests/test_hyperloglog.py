@@ -0,0 +1,68 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hyperloglog import HyperLogLog
+
+
+def _sketch(values, precision=8):
+    sketch = HyperLogLog(precision)
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+def test_sketch_stays_sparse_until_a_third_of_the_registers_are_set():
+    sketch = _sketch(range(10))
+    assert sketch.registers is None
+    assert sketch.count() == pytest.approx(10, abs=1)
+
+    sketch = _sketch(range(5000))
+    assert sketch.sparse is None
+    assert len(sketch.registers) == sketch.size
+    assert sketch.count() == pytest.approx(5000, rel=0.15)
+
+
+def test_promotion_keeps_every_register():
+    sketch = HyperLogLog(8)
+    for value in range(2000):
+        before = dict(sketch.sparse)
+        sketch.add(value)
+        if sketch.registers is not None:
+            break
+
+    assert len(before) * 3 < sketch.size <= (len(before) + 1) * 3
+    assert all(sketch.registers[index] >= rank for index, rank in before.items())
+    assert sum(1 for rank in sketch.registers if rank) == len(before) + 1
+    assert sketch.to_bytes() == _sketch(range(value + 1)).to_bytes()
+
+
+@pytest.mark.parametrize("left, right", [(range(0, 20), range(10, 30)),           # sparse + sparse
+                                         (range(0, 3000), range(2000, 2020)),     # dense + sparse
+                                         (range(0, 20), range(10, 3000)),         # sparse + dense
+                                         (range(0, 3000), range(1000, 5000))])    # dense + dense
+def test_merge_matches_adding_the_union(left, right):
+    union = _sketch(set(left) | set(right)).to_bytes()
+
+    assert _sketch(left).merge(_sketch(right)).to_bytes() == union
+    assert _sketch(left).merge_bytes(_sketch(right).to_bytes()).to_bytes() == union
+
+
+@pytest.mark.parametrize("count", [0, 5, 5000])
+def test_serialization_round_trip(count):
+    sketch = _sketch(range(count))
+    restored = HyperLogLog.from_bytes(sketch.to_bytes())
+
+    assert restored.to_bytes() == sketch.to_bytes()
+    assert restored.count() == sketch.count()
+    assert (restored.registers is None) == (sketch.registers is None)
+
+
+def test_sketches_of_different_precision_do_not_merge():
+    with pytest.raises(ValueError):
+        HyperLogLog(8).merge(HyperLogLog(10))
+    with pytest.raises(ValueError):
+        HyperLogLog(8).merge_bytes(HyperLogLog(10).to_bytes())
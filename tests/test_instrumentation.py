@@ -0,0 +1,58 @@
+import logging
+import os
+import sys
+
+import pytest
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import instrumentation
+from app import create_app
+from instrumentation import QueryStats, track
+from models import db
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'instrumentation.db'}", "TESTING": True})
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def _summaries(caplog):
+    return [record for record in caplog.records if record.getMessage() == "Query summary"]
+
+
+def test_summary_lists_slowest_statements_first_on_one_line():
+    stats = QueryStats('job', 'test')
+    stats.record("SELECT 1", 0.5)
+    stats.record("SELECT *\n  FROM customers", 2.0)
+
+    summary = stats.summary()
+    assert summary["queries"] == 2
+    assert summary["slowest"] == [{"seconds": 2.0, "statement": "SELECT * FROM customers"},
+                                  {"seconds": 0.5, "statement": "SELECT 1"}]
+
+
+def test_track_logs_the_slowest_statements(app, caplog):
+    caplog.set_level(logging.INFO, logger='instrumentation')
+    with app.app_context(), track('job', 'test'):
+        db.session.execute(text("SELECT 42"))
+
+    [record] = _summaries(caplog)
+    assert record.scope_name == 'test'
+    assert record.slowest[0]["statement"] == "SELECT 42"
+
+
+def test_slow_request_logs_its_summary(app, caplog, monkeypatch):
+    monkeypatch.setattr(instrumentation, 'SLOW_QUERY_SECONDS', 0.0)
+    caplog.set_level(logging.INFO, logger='instrumentation')
+
+    app.test_client().post('/user/signup', json={"email": "slow@example.com", "password": "secret"})
+
+    [record] = _summaries(caplog)
+    assert record.scope == 'request'
+    assert record.scope_name == 'user_bp.signup'
+    assert any("users" in entry["statement"] for entry in record.slowest)
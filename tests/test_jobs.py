@@ -0,0 +1,76 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import process_data
+from app import create_app
+from jobs import JobConflict, enqueue_job, fail_interrupted_jobs
+from models import db, CustobarIntegration, Job, User
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'jobs.db'}", "TESTING": True})
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(id=1, email="jobs@example.com", password="x"))
+        db.session.add(CustobarIntegration(id=1, api_key="key", user_id=1))
+        db.session.commit()
+        yield app
+
+
+def _wait_for(job_id, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        db.session.expire_all()
+        job = db.session.get(Job, job_id)
+        if job.status in ('succeeded', 'failed'):
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_failed_populate_metrics_marks_the_job_failed(app, monkeypatch):
+    def broken_queries(integration_id, cutoff):
+        raise RuntimeError("metrics query failed")
+
+    monkeypatch.setattr(process_data, 'metrics_queries', broken_queries)
+    job = enqueue_job('populate_metrics', 1, process_data.run_populate_metrics, 1)
+
+    job = _wait_for(job.id)
+    assert job.status == 'failed'
+    assert "metrics query failed" in job.error
+
+
+def test_second_job_of_the_same_kind_is_refused_while_one_is_active(app):
+    release = threading.Event()
+    first = enqueue_job('fetch_data', 1, lambda progress: release.wait(10))
+    try:
+        with pytest.raises(JobConflict) as conflict:
+            enqueue_job('fetch_data', 1, lambda progress: None)
+        assert conflict.value.job.id == first.id
+
+        # Other kinds are independent
+        other = enqueue_job('populate_metrics', 1, lambda progress: None)
+        assert _wait_for(other.id).status == 'succeeded'
+    finally:
+        release.set()
+
+    assert _wait_for(first.id).status == 'succeeded'
+    again = enqueue_job('fetch_data', 1, lambda progress: None)
+    assert _wait_for(again.id).status == 'succeeded'
+
+
+def test_fail_interrupted_jobs(app):
+    db.session.add_all([Job(kind='fetch_data', custobar_integration_id=1, status='running'),
+                        Job(kind='populate_metrics', custobar_integration_id=1, status='queued'),
+                        Job(kind='populate_metrics', custobar_integration_id=1, status='succeeded')])
+    db.session.commit()
+
+    assert fail_interrupted_jobs() == 2
+    assert sorted(job.status for job in Job.query.all()) == ['failed', 'failed', 'succeeded']
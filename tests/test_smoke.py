@@ -0,0 +1,109 @@
+import logging
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from models import db, Event
+from structured_logging import configure_logging
+
+
+def _config(tmp_path):
+    return {"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'smoke.db'}", "TESTING": True}
+
+
+@pytest.fixture
+def client(tmp_path):
+    app = create_app(_config(tmp_path))
+    with app.app_context():
+        db.create_all()
+    return app.test_client()
+
+
+def test_signup_and_metrics_endpoint(client):
+    response = client.post('/user/signup', json={"email": "smoke@example.com", "password": "secret"})
+    assert response.status_code == 201
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert 'custobar_db_queries_total{scope="request",scope_name="user_bp.signup"}' in body
+    assert 'custobar_scope_runs_total' in body
+
+
+def _log_from_worker(message):
+    logging.getLogger('worker').warning(message)
+
+
+def test_forked_worker_logs_reach_handler(capfd):
+    configure_logging()
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(1, mp_context=context, initializer=configure_logging) as executor:
+        executor.submit(_log_from_worker, 'hello from worker').result()
+    assert 'hello from worker' in capfd.readouterr().err
+
+
+def _integration_owner(client):
+    """Sign up, log in and add integration 1; returns the auth headers."""
+    client.post('/user/signup', json={"email": "owner@example.com", "password": "secret"})
+    token = client.post('/user/login', json={"email": "owner@example.com", "password": "secret"}).get_json()["token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post('/integration/add', json={"api_key": "key"}, headers=headers)
+    return headers
+
+
+@pytest.mark.parametrize('batch_size', ['many', 0, -5])
+def test_fetch_data_rejects_invalid_batch_size(client, batch_size):
+    headers = _integration_owner(client)
+    response = client.post('/integration/1/fetch_data', json={"batch_size": batch_size}, headers=headers)
+    assert response.status_code == 400
+
+
+def _write_metrics_in_another_app(config, integration_id):
+    from process_data import write_metrics
+
+    app = create_app(config)
+    with app.app_context():
+        write_metrics(integration_id, date.today(), {"transactions": 7})
+        db.session.commit()
+
+
+def test_metrics_cache_sees_writes_from_other_processes(client, tmp_path):
+    headers = _integration_owner(client)
+
+    first = client.get('/calculation/1/metrics?fields=transactions', headers=headers)
+    assert first.status_code == 200
+
+    # e.g. compute-metrics or a second web worker, which cannot touch this process's cache
+    with client.application.app_context():
+        db.engine.dispose()
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('fork')) as executor:
+        executor.submit(_write_metrics_in_another_app, _config(tmp_path), 1).result()
+
+    second = client.get('/calculation/1/metrics?fields=transactions',
+                        headers=dict(headers, **{"If-None-Match": first.headers["ETag"]}))
+    assert second.status_code == 200
+    assert second.headers["ETag"] != first.headers["ETag"]
+
+
+def test_refetched_event_adopts_backfilled_content_key(client):
+    from routes.integration_routes import event_content_key, save_events
+
+    event = {"id": "ev-1", "customer_id": "c1", "type": "BROWSE", "date": "2026-01-02T03:04:05", "path": "/shoes"}
+    with client.application.app_context():
+        # As left by the event_key migration: no Custobar id, so the content hash
+        db.session.add(Event(event_key=event_content_key("c1", "BROWSE", datetime(2026, 1, 2, 3, 4, 5), "/shoes"),
+                             cb_id="c1", event_type="BROWSE", date=datetime(2026, 1, 2, 3, 4, 5), path="/shoes",
+                             custobar_integration_id=1))
+        db.session.commit()
+
+        save_events([event], 1)
+        save_events([event], 1)
+
+        assert [stored.event_key for stored in Event.query.all()] == ["id:ev-1"]
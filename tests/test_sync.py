@@ -0,0 +1,79 @@
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from routes import integration_routes
+from app import create_app
+from models import db, CustobarIntegration, SyncCursor, User
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = create_app({"SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'sync.db'}", "TESTING": True})
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(id=1, email="sync@example.com", password="x"))
+        db.session.add(CustobarIntegration(id=1, api_key="key", user_id=1))
+        db.session.commit()
+        yield app
+
+
+def test_customers_are_synced_before_sales_and_events(app, monkeypatch):
+    log = []
+    lock = threading.Lock()
+
+    def fake_sync_resource(integration_id, resource, *args):
+        with lock:
+            log.append(('start', resource))
+        time.sleep(0.05)
+        with lock:
+            log.append(('end', resource))
+
+    monkeypatch.setattr(integration_routes, 'sync_resource', fake_sync_resource)
+    integration_routes.run_fetch_data(1, "key", {})
+
+    assert log[:2] == [('start', 'customers'), ('end', 'customers')]
+    # Sales and events overlap
+    assert {entry for entry in log[2:4]} == {('start', 'sales'), ('start', 'events')}
+
+
+def test_sync_resumes_from_the_page_after_a_failure(app):
+    integration_routes.update_sync_cursor(1, 'sales', last_seen=datetime(2026, 1, 1))
+    saved = []
+    requests = []
+
+    def save(records, integration_id):
+        saved.extend(record["external_id"] for record in records)
+
+    def failing_fetch(client, params, resume_url):
+        requests.append((params, resume_url))
+        yield [{"external_id": "sale-1", "date": "2026-01-05T10:00:00"}], "https://api/sales/?page=2"
+        raise RuntimeError("connection reset")
+
+    with pytest.raises(RuntimeError):
+        integration_routes.sync_resource(1, 'sales', failing_fetch, save, None, {})
+
+    cursor = SyncCursor.query.filter_by(custobar_integration_id=1, resource='sales').one()
+    assert cursor.resume_url == "https://api/sales/?page=2"
+    assert cursor.checkpoint == datetime(2026, 1, 5, 10)
+    assert cursor.last_seen == datetime(2026, 1, 1)
+
+    def resumed_fetch(client, params, resume_url):
+        requests.append((params, resume_url))
+        yield [{"external_id": "sale-2", "date": "2026-01-03T10:00:00"}], None
+
+    integration_routes.sync_resource(1, 'sales', resumed_fetch, save, None, {})
+
+    assert requests == [({"date__gte": "2026-01-01T00:00:00"}, None),
+                        ({"date__gte": "2026-01-01T00:00:00"}, "https://api/sales/?page=2")]
+    assert saved == ["sale-1", "sale-2"]
+    cursor = SyncCursor.query.filter_by(custobar_integration_id=1, resource='sales').one()
+    assert cursor.resume_url is None and cursor.checkpoint is None
+    # The checkpoint from before the failure is kept as the high-water mark
+    assert cursor.last_seen == datetime(2026, 1, 5, 10)